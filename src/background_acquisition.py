@@ -0,0 +1,178 @@
+import datetime
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Tuple
+from pypylon import pylon
+from image_basler import ImageBasler
+
+
+class BackgroundAcquisition:
+    """
+    Continuous acquisition of a camera in a background thread.
+
+    The camera grabs with GrabStrategy_LatestImageOnly and every frame is
+    converted as soon as it arrives, so the most recent frame is always
+    available in memory together with its age.
+
+    Other grabs on the same camera must run inside paused(), which waits for
+    the current retrieve to end and holds the thread until the grab is done.
+    """
+
+    def __init__(
+        self,
+        cam_iden: str,
+        camera: pylon.InstantCamera,
+        convert: Callable[[pylon.GrabResult], ImageBasler],
+        retrieve_timeout: int = 1000,
+        log: logging.Logger = None,
+    ) -> None:
+        """
+        Args:
+            cam_iden: identifier of the camera
+            camera: the opened camera, with exposure and color settings already applied
+            convert: function converting a successful grab result into an ImageBasler
+            retrieve_timeout: ms to wait for a frame, it also bounds the time needed to pause or stop
+        """
+        self.cam_iden = cam_iden
+        self._camera = camera
+        self._convert = convert
+        self._retrieve_timeout = retrieve_timeout
+        self._log = log if log is not None else logging.getLogger(__name__)
+
+        self._frame = None
+        self._frame_time = None
+        self._frame_count = 0
+        self._error_msg = None
+        self._new_frame = threading.Condition()
+        self._grab_lock = threading.Lock()
+        self._pause_requests = 0
+        self._pause_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+
+            # leave the camera to a paused grab
+            if self._pause_requests > 0:
+                time.sleep(0.001)
+                continue
+
+            with self._grab_lock:
+                try:
+                    if not self._camera.IsGrabbing():
+                        self._camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+                    grabResult = self._camera.RetrieveResult(
+                        self._retrieve_timeout, pylon.TimeoutHandling_Return
+                    )
+                    if grabResult is None or not grabResult.IsValid():
+                        continue
+                    if not grabResult.GrabSucceeded():
+                        grabResult.Release()
+                        continue
+                    image_basler = self._convert(grabResult)
+                    image_basler.image_info = {
+                        "timestamp": str(datetime.datetime.now())[:-7],
+                        **image_basler.image_info,
+                    }
+                except Exception as e:
+                    if self._camera.IsCameraDeviceRemoved():
+                        self._error_msg = f"Camera {self.cam_iden} removed: {e}"
+                        self._log.error(self._error_msg)
+                        self._stop_event.set()
+                        with self._new_frame:
+                            self._new_frame.notify_all()
+                        return
+                    self._log.warning(f"Background grab of camera {self.cam_iden} failed: {e}")
+                    continue
+
+            with self._new_frame:
+                self._frame = image_basler
+                self._frame_time = time.monotonic()
+                self._frame_count += 1
+                self._new_frame.notify_all()
+
+    def start(self) -> None:
+        if self.running():
+            return
+        self._stop_event.clear()
+        self._error_msg = None
+        self._thread = threading.Thread(
+            target=self._run, name=f"acquisition_{self.cam_iden}", daemon=True
+        )
+        self._thread.start()
+        self._log.info(f"Background acquisition started (camera: {self.cam_iden})")
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        with self._new_frame:
+            self._new_frame.notify_all()
+        self._log.info(f"Background acquisition stopped (camera: {self.cam_iden})")
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def error_msg(self) -> str:
+        return self._error_msg
+
+    def frame_count(self) -> int:
+        return self._frame_count
+
+    def camera(self) -> pylon.InstantCamera:
+        return self._camera
+
+    @contextmanager
+    def paused(self):
+        """
+        Hold the acquisition thread, so that the camera can be grabbed by the caller
+        """
+        with self._pause_lock:
+            self._pause_requests += 1
+        try:
+            with self._grab_lock:
+                yield
+        finally:
+            with self._pause_lock:
+                self._pause_requests -= 1
+
+    def latest(self, timeout: float = None) -> Tuple[ImageBasler, float]:
+        """
+        The most recent frame and its age in milliseconds.
+        If no frame has been acquired yet, it waits for the first one.
+
+        Args:
+            timeout: seconds to wait for the first frame, None to wait forever
+
+        Returns:
+            the frame and its age, the frame is None if the timeout expired
+            or the acquisition stopped
+        """
+        with self._new_frame:
+            self._new_frame.wait_for(
+                lambda: self._frame is not None or not self.running(), timeout
+            )
+            if self._frame is None:
+                return None, None
+            return self._frame, (time.monotonic() - self._frame_time) * 1e3
+
+    def wait_frame(self, count: int, timeout: float = None) -> Tuple[ImageBasler, int]:
+        """
+        Wait until more than count frames have been acquired
+
+        Returns:
+            the last frame and the number of frames acquired so far,
+            the frame is None if the timeout expired or the acquisition stopped
+        """
+        with self._new_frame:
+            self._new_frame.wait_for(
+                lambda: self._frame_count > count or not self.running(), timeout
+            )
+            if self._frame_count <= count:
+                return None, self._frame_count
+            return self._frame, self._frame_count
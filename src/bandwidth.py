@@ -0,0 +1,189 @@
+import logging
+import math
+from typing import Dict
+from pypylon import pylon
+from basler_utils import param_cache, get_tick_frequency
+
+
+class BandwidthScheduler:
+    """
+    Share the link of the GigE cameras during multi camera captures.
+
+    From the payload size, the packet size and the link speed of each camera,
+    it plans the transfers of one frame of all the cameras over the shared link,
+    and configures the cameras accordingly:
+    - pace: all the cameras transfer at the same time, each one slowed down by
+            the inter packet delay (GevSCPD) to its share of the link
+    - stagger: the cameras transfer at full speed one after the other, each one
+               delayed by the transfers of the previous ones (GevSCFTD)
+    In pace mode the transfers end together, in stagger mode they end one after
+    the other. In both modes the receiving NIC is never overrun, so frames are
+    not incomplete.
+
+    Times are planned from the end of the exposure. Stagger relies on all the
+    exposures ending together, so it is used only for synchronized captures,
+    the other captures are paced.
+    The delays are left on the cameras: cameras grabbing alone get them reset
+    to 0 (see reset), so a schedule never slows down the later grabs.
+    The cameras must not be used by other threads while they are scheduled,
+    since changing the packet size stops the grabbing.
+    """
+
+    modes = ["off", "pace", "stagger"]
+
+    # bytes of each packet on the wire not counted by the packet size:
+    # ethernet header and FCS, preamble and inter frame gap
+    wire_overhead = 38
+    # bytes of the packet size used by the IP, UDP and GVSP headers
+    header_size = 36
+    # leader and trailer packets of each frame
+    frame_packets = 2
+
+    def __init__(
+        self,
+        mode: str = "pace",
+        link_mbps: float = 1000,
+        headroom: float = 0.1,
+        packet_size: int = None,
+        log: logging.Logger = None,
+    ) -> None:
+        """
+        Args:
+            mode: one of the modes
+            link_mbps: speed of the link shared by the cameras (the host NIC) in Mbit/s
+            headroom: fraction of the link left unused, for resends and other traffic
+            packet_size: packet size set on the cameras (e.g. 8192 with jumbo frames), None to keep the camera value
+        """
+        if mode not in self.modes:
+            raise ValueError(f"Invalid bandwidth mode {mode}, available modes: {self.modes}")
+        self.mode = mode
+        self._link_bps = link_mbps * 1e6 * (1 - headroom) / 8
+        self._packet_size = packet_size
+        self._log = log if log is not None else logging.getLogger(__name__)
+
+    def _camera_params(self, camera: pylon.InstantCamera) -> dict:
+        """
+        Transfer parameters of a camera, the packet size is set first since it changes the payload
+        """
+        if self._packet_size is not None:
+            if param_cache.read(camera, "GevSCPSPacketSize") != self._packet_size:
+                # the packet size can not be changed while grabbing
+                if camera.IsGrabbing():
+                    camera.StopGrabbing()
+                param_cache.write(camera, "GevSCPSPacketSize", self._packet_size)
+        try:
+            camera_bps = camera.GevLinkSpeed.Value * 1e6 / 8
+        except:
+            camera_bps = self._link_bps
+        return {
+            "payload": camera.PayloadSize.Value,
+            "packet_size": param_cache.read(camera, "GevSCPSPacketSize"),
+            "camera_bps": camera_bps,
+            "tick_frequency": get_tick_frequency(camera),
+        }
+
+    def _wire_bytes(self, payload: int, packet_size: int) -> int:
+        """
+        Bytes sent on the wire for a frame
+        """
+        packets = math.ceil(payload / (packet_size - self.header_size)) + self.frame_packets
+        return payload + packets * (self.header_size + self.wire_overhead)
+
+    def plan(self, cams: Dict[str, pylon.InstantCamera], mode: str = None) -> Dict[str, dict]:
+        """
+        Plan the transfer of one frame of each camera over the shared link
+
+        Args:
+            cams: opened cameras by identifier
+            mode: pace or stagger, if None the mode of the scheduler is used
+
+        Returns:
+            for each camera: the planned start and end of the transfer (start_ms, end_ms),
+            the inter packet delay and the frame transmission delay in camera ticks
+        """
+
+        if mode is None:
+            mode = self.mode
+        plan = {}
+        start = 0
+        for cam_iden, camera in cams.items():
+            p = self._camera_params(camera)
+            wire_bytes = self._wire_bytes(p["payload"], p["packet_size"])
+            packet_bytes = p["packet_size"] + self.wire_overhead
+
+            if mode == "pace":
+                # each camera gets its share of the link
+                rate = min(self._link_bps / len(cams), p["camera_bps"])
+                delay_s = max(0, packet_bytes / rate - packet_bytes / p["camera_bps"])
+                plan[cam_iden] = {
+                    "start_ms": 0,
+                    "end_ms": wire_bytes / rate * 1e3,
+                    "packet_delay": int(delay_s * p["tick_frequency"]),
+                    "transmission_delay": 0,
+                }
+            else:
+                # full speed, after the previous cameras
+                rate = min(self._link_bps, p["camera_bps"])
+                end = start + wire_bytes / rate
+                plan[cam_iden] = {
+                    "start_ms": start * 1e3,
+                    "end_ms": end * 1e3,
+                    "packet_delay": 0,
+                    "transmission_delay": int(start * p["tick_frequency"]),
+                }
+                start = end
+        return plan
+
+    def _write_delays(
+        self, cam_iden: str, camera: pylon.InstantCamera, packet_delay: int, transmission_delay: int
+    ) -> None:
+        try:
+            param_cache.write(camera, "GevSCPD", packet_delay)
+            param_cache.write(camera, "GevSCFTD", transmission_delay)
+        except Exception as e:
+            self._log.warning(f"Transfer delays of camera {cam_iden} not set: {e}")
+
+    def reset(self, cams: Dict[str, pylon.InstantCamera]) -> None:
+        """
+        Remove the delays of a previous schedule, the cameras transfer at full speed.
+        The nodes are written only if changed, nothing is done if the scheduler is off.
+        """
+        if self.mode == "off":
+            return
+        for cam_iden, camera in cams.items():
+            self._write_delays(cam_iden, camera, 0, 0)
+
+    def schedule(
+        self, cams: Dict[str, pylon.InstantCamera], synchronized: bool = False
+    ) -> Dict[str, dict]:
+        """
+        Plan the transfers and configure the cameras, the nodes are written only if changed.
+        A single camera has the link for itself, its delays are reset.
+
+        Args:
+            cams: opened cameras by identifier
+            synchronized: True if the exposures of the cameras end together (triggered at once),
+                          otherwise the transfers are paced also in stagger mode
+
+        Returns:
+            the plan, empty if the scheduler is off or there is only one camera
+        """
+
+        if self.mode == "off" or len(cams) == 0:
+            return {}
+        if len(cams) == 1:
+            self.reset(cams)
+            return {}
+
+        mode = self.mode if synchronized else "pace"
+        plan = self.plan(cams, mode)
+        for cam_iden, camera in cams.items():
+            self._write_delays(
+                cam_iden, camera, plan[cam_iden]["packet_delay"], plan[cam_iden]["transmission_delay"]
+            )
+
+        planned_ms = max([p["end_ms"] for p in plan.values()])
+        self._log.info(
+            f"Transfers scheduled ({mode}) for {len(cams)} cameras, planned time: {planned_ms:.0f} ms"
+        )
+        return plan
@@ -1,12 +1,24 @@
 from pypylon import pylon, genicam
 from basler_utils import (
     set_autoexposure,
+    start_autoexposure,
     set_exposure,
+    clamp_exposure,
     set_fps,
     get_exposure,
     white_balancing,
     set_gamma,
     remove_autogain,
+    set_software_trigger,
+    ptp_enabled,
+    get_tick_frequency,
+    camera_boot_time,
+    camera_ticks,
+    set_pixel_format,
+    set_sequencer,
+    reset_sequencer,
+    bayer_pixel_formats,
+    param_cache,
 )
 import shutil
 import datetime
@@ -14,18 +26,45 @@ from collections import defaultdict
 from copy import deepcopy
 from prettytable import PrettyTable
 import json
+import hashlib
 import cv2
+import numpy as np
 import os
 import itertools
-from typing import Union, List, Dict, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+from typing import Union, List, Dict, Tuple, Generator
 from omegaconf import OmegaConf
 import logging
 from pathlib import Path
-from image_basler import ImageBasler
+from image_basler import ImageBasler, encodings, encode_image, pixel_formats
+from image_writer import ImageWriter
+from results_store import ResultsStore
+from frame_cache import FrameCache
+from frame_pool import FramePool
+from background_acquisition import BackgroundAcquisition
+from bandwidth import BandwidthScheduler
 from qrcode import QRCodeDetector
+from qrcode_stage import QRCodeStage
+from hdr import fuse_exposures
 from constants import forbidden_chars_win
 
 
+class RemovalEventHandler(pylon.ConfigurationEventHandler):
+    """
+    Forward the removal of the cameras to a callback
+    """
+
+    def __init__(self, on_removed) -> None:
+        super().__init__()
+        self._on_removed = on_removed
+
+    def OnCameraDeviceRemoved(self, camera: pylon.InstantCamera) -> None:
+        self._on_removed(camera)
+
+
 class BaslerHandler:
 
     def __init__(self, config_path: str) -> None:
@@ -39,13 +78,53 @@ class BaslerHandler:
         self._cfg = OmegaConf.load(config_path)  # load config file
         self._setup_logger()  # setup logger
 
+        # camera session, kept across captures
+        self._cam_array = None
+        self._devices = []
+        self._devices_info_current = {}
+        # index of the cameras of the session: camera slot by match keys and by identifier
+        self._slot_by_key: Dict[tuple, int] = {}
+        self._slot_by_iden: Dict[str, int] = {}
+        # cached enumeration, invalidated by the removal of a camera
+        self._enumerated_at = 0
+        self._devices_removed = threading.Event()
+        self._removal_handler = RemovalEventHandler(self._on_device_removed)
+        self._acquisitions: Dict[str, BackgroundAcquisition] = {}
+        self._lock = threading.RLock()
+
+        # viewers of the live streams
+        self._stream_viewers = defaultdict(int)
+        self._stream_started = set()
+        self._stream_encoded = {}
+        self._stream_lock = threading.Lock()
+
         # log startin session
         self._log.info("Basler handler started")
         self._log.info(f"Configfile: {config_path}\n")
 
-        # set pixel format
-        self._converter = pylon.ImageFormatConverter()
-        self._converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+        # transfers of the cameras sharing the link, planned for each capture
+        bandwidth = self._cfg.grab.bandwidth
+        self._bandwidth = BandwidthScheduler(
+            mode=bandwidth.mode,
+            link_mbps=bandwidth.link_mbps,
+            headroom=bandwidth.headroom,
+            packet_size=bandwidth.packet_size,
+            log=self._log,
+        )
+        self._transfer_plan = {}
+
+        # creation of the feature files of the camera models
+        self._pfs_lock = threading.Lock()
+
+        # pixel format converters, one for each grabbing thread
+        self._converters = threading.local()
+
+        # preallocated output buffers of the converted frames, one pool for each camera
+        self._frame_pools = {}
+        self._frame_pools_lock = threading.Lock()
+
+        # statistics of the last auto exposure of each camera
+        self._exposure_stats = {}
 
         # load configured cams
         r = self._load_configured_cams()
@@ -60,14 +139,46 @@ class BaslerHandler:
         # qrcode detector
         self.qrcodes = QRCodeDetector(config_path)
 
+        # index of the captured images, migrated from the old results json
+        self._results = ResultsStore(
+            self._cfg.results.path_db, self._cfg.results.max_result_num, log=self._log
+        )
+        self._results.migrate_json(self._cfg.results.path_json)
+
+        # last frame of each camera, kept in memory
+        self._frames = FrameCache(int(self._cfg.results.cache.max_mb * 1e6))
+
+        # background image writer
+        self._writer = None
+        if self._cfg.results.writer.enabled:
+            self._writer = ImageWriter(
+                num_workers=self._cfg.results.writer.workers,
+                queue_size=self._cfg.results.writer.queue_size,
+                put_timeout=self._cfg.results.writer.put_timeout,
+                log=self._log,
+            )
+
+        # qrcodes decoded right after the capture
+        self._qrcode_stage = QRCodeStage(
+            lambda image_basler: self.decode_qrcodes(image_basler)["qrcodes"],
+            self._results,
+            num_workers=self._cfg.qrcode.stage.workers,
+            log=self._log,
+        )
+
         self._load_features()
 
+        # background acquisitions enabled in the camera configuration
+        for cam_iden, device_info in self._devices_info_configured.items():
+            if device_info.get("background_acquisition", False):
+                self.start_background_acquisition(cam_iden)
+
     def __del__(self) -> None:
         """
         Close the camera array
         """
         try:
-            self._cam_array.Close()
+            self.close()
         except:
             {}
         self._log.info("Session ended\n")
@@ -83,49 +194,143 @@ class BaslerHandler:
         if not Path(self._cfg.data.pfs_dir).exists():
             raise ValueError(f"Path {self._cfg.data.pfs_dir} does not exist")
         else:
-            info = list(self._devices_info_configured.keys())
+            for k in self._devices_info_configured.keys():
+                if k not in self._slot_by_iden.keys():
+                    self._log.warning(f"camera {k} is not available!!")
+
+            # configured cameras of the session
+            jobs = [
+                (i, self._cam_array[i], self._devices[i], k)
+                for k, i in self._slot_by_iden.items()
+            ]
 
-            sns_c = [v['SerialNumber'] for v in self._devices_info_configured.values()]
-            sns_d = [d.GetSerialNumber() for d in self._devices]
-            ks_c = [k for k in self._devices_info_configured.keys()]
-            for i, sn in enumerate(sns_c):
-                if not sn in sns_d:
-                    self._log.warning(f"camera {ks_c[i]} is not available!!")
+            # hashes of the feature files loaded on each camera, by serial number
+            try:
+                with open(self._cfg.data.pfs_loaded, "r") as f:
+                    loaded = json.load(f)
+            except:
+                loaded = {}
+
+            # feature files are loaded on all the cameras in parallel
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+                results = list(
+                    executor.map(lambda job: self._load_camera_features(*job, loaded), jobs)
+                )
+            for serial_number, entry in results:
+                if entry is not None:
+                    loaded[serial_number] = entry
+            self._log.info(
+                f"Features of {len(jobs)} cameras loaded in {(time.perf_counter() - start) * 1e3:.0f} ms"
+            )
 
-            
-            for i, cam in enumerate(self._cam_array):
-                try:
-                    device = self._devices[i]
-                    #import ipdb; ipdb.set_trace()
-                    name_cam = None
-                    for k,v in self._devices_info_configured.items():
-                        sn_c = v['SerialNumber']
-                        sn_d = device.GetSerialNumber()
-                        if sn_c == sn_d:
-                            name_cam = k
-                    if name_cam is None:
-                        
-                        continue
-                    #print(device.GetAddress())
-                    cam.Open()
-                    name_model = device.GetModelName()
-                    #name_cam= info[i]
-                    path_cam = Path(self._cfg.data.pfs_dir) / f"{name_cam}.pfs"
-                    path_model = Path(self._cfg.data.pfs_dir) / f"{name_model}.pfs"
-                    if not path_model.exists():
-                        self._log.warning(f"Feature file for camera model {name_model} not found, creating new one")
-                        pylon.FeaturePersistence.Save(str(path_model), cam.GetNodeMap())
-                    if path_cam.exists():
-                        self._log.info(f"Loading features for camera {i} ({name_cam})")
-                        pylon.FeaturePersistence.Load(str(path_cam), cam.GetNodeMap(), True)
-                    else:
-                        self._log.warning(f"Feature file for camera {name_cam} not found, loading from camera model")
-                        pylon.FeaturePersistence.Load(str(path_model), cam.GetNodeMap(), True)
-                        self._log.warning(f"Save features for camera {name_cam}")
-                        pylon.FeaturePersistence.Save(str(path_cam), cam.GetNodeMap())
+            try:
+                with open(self._cfg.data.pfs_loaded, "w") as f:
+                    json.dump(loaded, f, indent=4)
+            except Exception as e:
+                self._log.warning(f"Hashes of the loaded feature files not saved: {e}")
+
+    @staticmethod
+    def _same_boot(last_boot_time: float, boot_time: float) -> bool:
+        """
+        True if two boot times of a camera are the same boot, allowing for the latency
+        of the reads and the drift between the camera and the host clocks (100 ppm)
+        """
+        if last_boot_time is None or boot_time is None:
+            return False
+        tolerance = 5 + 1e-4 * abs(time.time() - last_boot_time)
+        return abs(boot_time - last_boot_time) <= tolerance
+
+    def _load_camera_features(
+        self,
+        i: int,
+        cam: pylon.InstantCamera,
+        device: pylon.DeviceInfo,
+        name_cam: str,
+        loaded: dict,
+    ) -> Tuple[str, dict]:
+        """
+        Load the feature file of a camera, its own file or the file of its model.
+        Loading is skipped if the file did not change since it was loaded on the camera
+        and the camera has not been rebooted since then (same boot time, see camera_boot_time).
+        The features written after the load are then still on the camera: the ones changed
+        by the grabs of this application that the grabs do not set again (trigger, sequencer,
+        transfer delays) are reset, any other change (e.g. by other applications) is not detected.
+
+        Returns:
+            the serial number of the camera and the hashes of the loaded feature file,
+            None if the features could not be loaded
+        """
+
+        start = time.perf_counter()
+        serial_number = device.GetSerialNumber()
+        try:
+            #print(device.GetAddress())
+            cam.Open()
+            name_model = device.GetModelName()
+            path_cam = Path(self._cfg.data.pfs_dir) / f"{name_cam}.pfs"
+            path_model = Path(self._cfg.data.pfs_dir) / f"{name_model}.pfs"
+            # cameras of the same model share the model file
+            with self._pfs_lock:
+                if not path_model.exists():
+                    self._log.warning(f"Feature file for camera model {name_model} not found, creating new one")
+                    pylon.FeaturePersistence.Save(str(path_model), cam.GetNodeMap())
+
+            boot_time = camera_boot_time(cam)
+            if path_cam.exists():
+                last = loaded.get(serial_number, None)
+                pfs_hash = hashlib.sha256(path_cam.read_bytes()).hexdigest()
+                if (
+                    self._cfg.data.pfs_skip_unchanged
+                    and last is not None
+                    and last["pfs"] == path_cam.name
+                    and last["pfs_hash"] == pfs_hash
+                    and self._same_boot(last.get("boot_time", None), boot_time)
+                ):
+                    self._reset_runtime_features(cam, name_cam)
+                    self._log.info(
+                        f"Features for camera {i} ({name_cam}) unchanged, "
+                        f"checked in {(time.perf_counter() - start) * 1e3:.0f} ms"
+                    )
                     cam.Close()
-                except:
-                    pass
+                    return serial_number, last
+
+                # loaded features replace the values written so far
+                param_cache.invalidate(cam)
+                pylon.FeaturePersistence.Load(str(path_cam), cam.GetNodeMap(), True)
+            else:
+                self._log.warning(f"Feature file for camera {name_cam} not found, loading from camera model")
+                param_cache.invalidate(cam)
+                pylon.FeaturePersistence.Load(str(path_model), cam.GetNodeMap(), True)
+                self._log.warning(f"Save features for camera {name_cam}")
+                pylon.FeaturePersistence.Save(str(path_cam), cam.GetNodeMap())
+                pfs_hash = hashlib.sha256(path_cam.read_bytes()).hexdigest()
+
+            entry = {
+                "pfs": path_cam.name,
+                "pfs_hash": pfs_hash,
+                "boot_time": boot_time,
+            }
+            self._log.info(
+                f"Features for camera {i} ({name_cam}) loaded in {(time.perf_counter() - start) * 1e3:.0f} ms"
+            )
+            cam.Close()
+            return serial_number, entry
+        except Exception as e:
+            self._log.warning(f"Features for camera {i} ({name_cam}) not loaded: {e}")
+            return serial_number, None
+
+    def _reset_runtime_features(self, cam: pylon.InstantCamera, name_cam: str) -> None:
+        """
+        Back to free run, with the sequencer off and without transfer delays, as a grab left
+        interrupted (e.g. by a crash) could have left the camera. The camera must not be grabbing.
+        """
+        try:
+            set_software_trigger(cam, False)
+            reset_sequencer(cam)
+        except Exception as e:
+            self._log.warning(f"Trigger of camera {name_cam} not reset: {e}")
+        self._bandwidth.reset({name_cam: cam})
 
     def _devices_info_to_string(self, devices_info: dict) -> str:
         """
@@ -183,6 +388,11 @@ class BaslerHandler:
             devices_info[key]["rotation"] = 0
             devices_info[key]["exposure_time"] = self._cfg.grab.exposure_time_default
             devices_info[key]["gamma"] = 0.5
+            devices_info[key]["pixel_format"] = "bgr"
+            devices_info[key]["encoding"] = self._cfg.results.encoding.format
+            devices_info[key]["encoding_quality"] = self._cfg.results.encoding.quality
+            devices_info[key]["background_acquisition"] = False
+            devices_info[key]["qr_rois"] = None
 
         return devices_info
 
@@ -215,34 +425,369 @@ class BaslerHandler:
         self._log.addHandler(file_handler)
         self._log.addHandler(console_handler)
 
-    def _load_devices(self) -> None:
+    def _load_devices(self, force: bool = False) -> None:
         """
-        Load camera devices
+        Load camera devices. The enumeration is cached for session.enumeration_ttl
+        seconds, or until a camera is removed, and the cameras of the devices
+        that did not change are kept with their state (opened, grabbing, acquiring).
+
+        Args:
+            force: enumerate the devices even if the cached enumeration is still valid
         """
 
-        # load devices
-        tlf = pylon.TlFactory.GetInstance()
-        self._devices = tlf.EnumerateDevices(
-            [
-                pylon.DeviceInfo(),
-            ]
+        with self._lock:
+
+            # cached enumeration
+            if (
+                not force
+                and self._cam_array is not None
+                and not self._devices_removed.is_set()
+                and time.monotonic() - self._enumerated_at < self._cfg.session.enumeration_ttl
+            ):
+                return
+            self._devices_removed.clear()
+
+            # load devices
+            tlf = pylon.TlFactory.GetInstance()
+            devices = tlf.EnumerateDevices(
+                [
+                    pylon.DeviceInfo(),
+                ]
+            )
+            self._enumerated_at = time.monotonic()
+
+            # keep the cameras of the devices still available
+            names = [d.GetFullName() for d in devices]
+            kept, released = {}, []
+            for cam in self._cam_array if self._cam_array is not None else []:
+                name = cam.GetDeviceInfo().GetFullName()
+                if name in names and not cam.IsCameraDeviceRemoved():
+                    kept[name] = cam
+                else:
+                    released.append(cam)
+
+            # release the cameras of removed devices
+            acquiring = self._stop_acquisitions(released)
+            if len(released) > 0:
+                self._drop_frame_pools(self._cam_idens_of(released))
+            for cam in released:
+                try:
+                    cam.StopGrabbing()
+                    cam.Close()
+                    cam.DestroyDevice()
+                except:
+                    {}
+
+            # cameras of the session, in enumeration order
+            cams = []
+            for idx, device in enumerate(devices):
+                cam = kept.get(device.GetFullName(), None)
+                if cam is None:
+                    cam = pylon.InstantCamera(tlf.CreateDevice(device))
+                    cam.RegisterConfiguration(
+                        self._removal_handler,
+                        pylon.RegistrationMode_Append,
+                        pylon.Cleanup_None,
+                    )
+                    # reconnected cameras may have lost the written parameters
+                    param_cache.invalidate(cam)
+                cam.SetCameraContext(idx)
+                cams.append(cam)
+
+            if len(released) > 0 or len(cams) > len(kept):
+                self._log.info(
+                    f"Devices enumerated: {len(kept)} kept, {len(cams) - len(kept)} new, {len(released)} released"
+                )
+
+            self._devices = devices
+            self._n_devices = len(devices)
+            self._cam_array = cams
+
+            # update device infos
+            self._devices_info_current = self._get_devices_info()
+            self._build_cam_index()
+
+            # restart the background acquisitions of reconnected cameras
+            for cam_iden in acquiring:
+                r = self._start_acquisition(cam_iden)
+                if isinstance(r, str):
+                    self._log.error(f"Background acquisition not restarted: {r}")
+
+    def _on_device_removed(self, camera: pylon.InstantCamera) -> None:
+        """
+        Called by pylon when a camera is removed, the next use of the devices enumerates them again
+        """
+        self._devices_removed.set()
+        self._drop_frame_pools(self._cam_idens_of([camera]))
+        self._log.warning(
+            f"Camera {camera.GetDeviceInfo().GetSerialNumber()} removed"
+        )
+
+    def _ensure_devices(self, cam_idens: List[str] = None) -> None:
+        """
+        Reuse the current camera session, enumerating devices again only if
+        there is no session yet, a camera has been removed or one of the
+        requested cameras is missing (at most once per session.enumeration_ttl)
+
+        Args:
+            cam_idens: identifiers of the cameras that are going to be used
+        """
+
+        if self._cam_array is None or not self._cfg.session.keep_open:
+            self._load_devices()
+            return
+
+        # reconnect if a device disappeared
+        removed = [cam for cam in self._cam_array if cam.IsCameraDeviceRemoved()]
+        if len(removed) > 0:
+            self._log.warning(f"{len(removed)} camera(s) removed, reconnecting")
+            self._load_devices(force=True)
+            return
+
+        # look for requested cameras missing from the session
+        if cam_idens is not None:
+            for cam_iden in cam_idens:
+                if cam_iden in self._devices_info_configured.keys() and isinstance(
+                    self._get_cam_from_iden(cam_iden), str
+                ):
+                    self._log.info(f"Camera {cam_iden} not in session, reconnecting")
+                    self._load_devices()
+                    return
+
+    def _release_cams(self) -> None:
+        """
+        Stop the cameras after a grab, unless the session is kept open
+        or some camera is acquiring in background
+        """
+        if not self._cfg.session.keep_open and len(self._acquisitions) == 0:
+            self._stop_cams()
+
+    def _acquisition_paused(self, cam_iden: str):
+        """
+        Context in which the background acquisition of a camera, if any, is paused
+        """
+        acquisition = self._acquisitions.get(cam_iden, None)
+        if acquisition is None or not acquisition.running():
+            return nullcontext()
+        return acquisition.paused()
+
+    def _start_acquisition(self, cam_iden: str) -> Union[bool, str]:
+        """
+        Start the background acquisition of a camera in the current session,
+        with the exposure time and gamma configured for the camera
+
+        Returns:
+            True if the acquisition started, an error message otherwise
+        """
+
+        device_info = self._devices_info_configured.get(cam_iden, {})
+        exposure_time = device_info.get("exposure_time", "auto")
+        camera = self._prepare_camera(cam_iden, "default", device_info.get("gamma", 0.5))
+        if isinstance(camera, str):
+            return camera
+
+        # the camera streams alone, at full speed
+        self._bandwidth.reset({cam_iden: camera})
+
+        # the camera keeps adjusting the exposure while streaming, hdr frames are not fused
+        if exposure_time in ["auto", "hdr"]:
+            start_autoexposure(camera, self._cfg.grab.autoexposure.brightness_val)
+        else:
+            self._set_exposure(camera, exposure_time)
+
+        acquisition = BackgroundAcquisition(
+            cam_iden,
+            camera,
+            lambda grabResult: self._image_from_result(
+                cam_iden, camera, grabResult, exposure_time
+            ),
+            retrieve_timeout=self._cfg.acquisition.retrieve_timeout,
+            log=self._log,
         )
+        acquisition.start()
+        self._acquisitions[cam_iden] = acquisition
+        return True
+
+    def _open_stream(self, cam_iden: str) -> Union[bool, str]:
+        """
+        Register a viewer of the stream of a camera, starting its background
+        acquisition if it is the first viewer
+
+        Returns:
+            True if the stream is available, an error message otherwise
+        """
+        with self._stream_lock:
+            acquisition = self._acquisitions.get(cam_iden, None)
+            if acquisition is None or not acquisition.running():
+                r = self.start_background_acquisition(cam_iden)
+                if isinstance(r, str):
+                    return r
+                self._stream_started.add(cam_iden)
+            self._stream_viewers[cam_iden] += 1
+            return True
+
+    def _close_stream(self, cam_iden: str) -> None:
+        """
+        Unregister a viewer of the stream of a camera, stopping the background
+        acquisition with the last viewer if it was started for the stream
+        """
+        with self._stream_lock:
+            self._stream_viewers[cam_iden] -= 1
+            if self._stream_viewers[cam_iden] > 0:
+                return
+            for key in [k for k in self._stream_encoded.keys() if k[0] == cam_iden]:
+                self._stream_encoded.pop(key)
+            if cam_iden in self._stream_started:
+                self._stream_started.discard(cam_iden)
+                self.stop_background_acquisition(cam_iden)
+
+    def _stream_encode(
+        self,
+        cam_iden: str,
+        image_basler: ImageBasler,
+        count: int,
+        scale: float,
+        quality: int,
+    ) -> bytes:
+        """
+        Resize and encode a stream frame, reusing the encoding of other
+        viewers with the same settings
+        """
+        key = (cam_iden, scale, quality)
+        cached = self._stream_encoded.get(key, None)
+        if cached is not None and cached[0] == count:
+            return cached[1]
 
-        self._n_devices = len(self._devices)
+        encoded = encode_image(image_basler.thumbnail(scale), "jpeg", quality)
+        self._stream_encoded[key] = (count, encoded)
+        return encoded
 
-        # set camera array
-        self._cam_array = pylon.InstantCameraArray(self._n_devices)
-        for idx, cam in enumerate(self._cam_array):
-            cam.Attach(tlf.CreateDevice(self._devices[idx]))
-            cam.SetCameraContext(idx)
+    def _stop_acquisitions(self, cams: List[pylon.InstantCamera] = None) -> List[str]:
+        """
+        Stop the background acquisitions of some cameras, all of them if cams is None
+
+        Returns:
+            the identifiers of the stopped cameras
+        """
+        cam_idens = [
+            cam_iden
+            for cam_iden, acquisition in self._acquisitions.items()
+            if cams is None or any([acquisition.camera() is cam for cam in cams])
+        ]
+        for cam_iden in cam_idens:
+            self._acquisitions.pop(cam_iden).stop()
+        return cam_idens
+
+    def _get_converter(self, pixel_format: str = "bgr") -> pylon.ImageFormatConverter:
+        """
+        Get the pixel format converter of the calling thread for an output pixel format,
+        converters are not shared since cameras can be grabbed concurrently
+        """
 
-        # update device infos
-        self._devices_info_current = self._get_devices_info()
+        if not hasattr(self._converters, "converters"):
+            self._converters.converters = {}
+        converters = self._converters.converters
+        if pixel_format not in converters.keys():
+            converter = pylon.ImageFormatConverter()
+            if pixel_format == "mono8":
+                converter.OutputPixelFormat = pylon.PixelType_Mono8
+            else:
+                converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+            converters[pixel_format] = converter
+        return converters[pixel_format]
+
+    def _frame_pool(self, cam_iden: str) -> FramePool:
+        """
+        Buffer pool of the frames of a camera, None if the pool is disabled
+        """
+        max_buffers = self._cfg.grab.frame_pool.max_buffers
+        if not max_buffers:
+            return None
+        with self._frame_pools_lock:
+            if cam_iden not in self._frame_pools.keys():
+                self._frame_pools[cam_iden] = FramePool(max_buffers)
+            return self._frame_pools[cam_iden]
+
+    def _drop_frame_pools(self, cam_idens: List[str]) -> None:
+        """
+        Drop the buffer pools of some cameras, e.g. removed cameras or cameras with a new pixel format
+        """
+        with self._frame_pools_lock:
+            for cam_iden in cam_idens:
+                pool = self._frame_pools.pop(cam_iden, None)
+                if pool is not None:
+                    pool.clear()
+
+    def _cam_idens_of(self, cams: List[pylon.InstantCamera]) -> List[str]:
+        """
+        Identifiers of some cameras of the session
+        """
+        return [
+            cam_iden
+            for cam_iden, slot in self._slot_by_iden.items()
+            if slot < len(self._cam_array) and any([self._cam_array[slot] is cam for cam in cams])
+        ]
+
+    @staticmethod
+    def _copy_array(
+        image: Union[pylon.GrabResult, pylon.PylonImage], pool: FramePool
+    ) -> np.ndarray:
+        """
+        Copy the array of a grab result or of a pylon image, into a buffer of the pool if given
+        """
+        if pool is None:
+            return image.GetArray()
+        with image.GetArrayZeroCopy() as array:
+            buffer = pool.acquire(array.shape, array.dtype)
+            np.copyto(buffer, array)
+        return buffer
+
+    def _convert_result(
+        self, grabResult: pylon.GrabResult, pixel_format: str, pool: FramePool = None
+    ) -> Tuple[np.ndarray, str, str]:
+        """
+        Copy the image of a grab result in the output pixel format of the camera.
+        Native buffers (Mono8 for mono8, 8 bit bayer for bayer) are copied without conversions,
+        bayer is delivered as mono8 by mono cameras and as bgr by other color formats.
+        With a pool, the image is written in a buffer of the pool and the conversion
+        reuses the pylon image of the converter, so no memory is allocated.
+
+        Returns:
+            the image, its pixel format and its bayer pattern (None if not bayer)
+        """
+
+        pixel_type = grabResult.GetPixelType()
+        if pixel_format == "bayer":
+            for bayer_format in bayer_pixel_formats:
+                if pixel_type == getattr(pylon, "PixelType_" + bayer_format):
+                    return self._copy_array(grabResult, pool), "bayer", bayer_format
+            pixel_format = "mono8" if pylon.IsMono(pixel_type) else "bgr"
+        if pixel_format == "mono8" and pixel_type == pylon.PixelType_Mono8:
+            return self._copy_array(grabResult, pool), "mono8", None
+
+        converter = self._get_converter(pixel_format)
+        if pool is None:
+            return converter.Convert(grabResult).GetArray(), pixel_format, None
+
+        # target of the conversions of the calling thread, reallocated only if the size changes
+        if not hasattr(self._converters, "images"):
+            self._converters.images = {}
+        images = self._converters.images
+        if pixel_format not in images.keys():
+            images[pixel_format] = pylon.PylonImage()
+        converter.Convert(images[pixel_format], grabResult)
+        return self._copy_array(images[pixel_format], pool), pixel_format, None
 
     def _set_fps(self, camera: pylon.InstantCamera, fps: int) -> None:
         set_fps(camera, fps)
 
-    def _set_exposure(self, camera: pylon.InstantCamera, exposure_time: int) -> None:
+    def _set_exposure(
+        self,
+        camera: pylon.InstantCamera,
+        exposure_time: int,
+        gamma: float = 1.0,
+        deadline: float = None,
+    ) -> dict:
         """
         Set exposure time of a camera given its id
 
@@ -252,24 +797,33 @@ class BaslerHandler:
                            can be an int, indicating the exposure time in microseconds to apply
                            if 'auto', auto exposure is used
                            if None, it is set to 'auto'
+                           if 'settled', the exposure time has already been set by a concurrent auto exposure
+                           if 'hdr', auto exposure is used to find the center of the exposure bracket
+            gamma: gamma applied by the camera, used by auto exposure
+            deadline: time.perf_counter() value at which auto exposure stops
 
-
+        Returns:
+            the auto exposure statistics if exposure_time is 'auto' or 'hdr', None otherwise
         """
 
         # set fixed exposure time
-        if exposure_time == "auto":
-            set_autoexposure(
+        if exposure_time in ["auto", "hdr"]:
+            cfg = self._cfg.grab.autoexposure
+            return set_autoexposure(
                 camera,
-                self._cfg.grab.autoexposure.brightness_val,
+                cfg.brightness_val,
                 self._cfg.grab.timeout,
+                tolerance=cfg.tolerance,
+                max_iterations=cfg.max_iterations,
+                settle_frames=cfg.settle_frames,
+                step=cfg.subsampling,
+                gamma=gamma,
+                deadline=deadline,
             )
 
-        elif exposure_time == "default":
+        elif exposure_time in ["default", "settled"]:
             pass
 
-        elif exposure_time == "hdr":
-            raise Excepton("HDR mode not implemented yet")
-
         else:
             set_exposure(camera, exposure_time)
 
@@ -277,23 +831,46 @@ class BaslerHandler:
         # camera.Open()
         # camera.StartGrabbing(pylon.GrabStrategy_LatestImages)
 
+    def _get_encoding(
+        self, cam_iden: str, encoding: str = None, quality: int = None
+    ) -> Tuple[str, int]:
+        """
+        Get the encoding of the images of a camera: the requested one if given,
+        otherwise the one configured for the camera, otherwise the default one in the config file.
+        The quality is taken from the camera or the config file only if they use the same encoding.
+        """
+
+        device_info = self._devices_info_configured.get(cam_iden, {})
+        cfg_encoding = self._cfg.results.encoding
+        cam_encoding = device_info.get("encoding", cfg_encoding.format)
+        if encoding is None:
+            encoding = cam_encoding
+        if quality is None:
+            if encoding == cam_encoding and "encoding" in device_info.keys():
+                quality = device_info.get("encoding_quality", None)
+            elif encoding == cfg_encoding.format:
+                quality = cfg_encoding.quality
+        return encoding, quality
+
     def _stop_cams(self) -> None:
         """
         Stop all cameras from grabbing images
         """
 
-        self._cam_array.StopGrabbing()
-        self._cam_array.Close()
+        for cam in self._cam_array:
+            cam.StopGrabbing()
+            cam.Close()
 
-    def _grab_basic(
+    def _prepare_camera(
         self,
         cam_iden: str,
         exposure_time: Union[int, str] = None,
         gamma: float = 0.5,
-        log=True,
-    ) -> dict:
+        deadline: float = None,
+    ) -> Union[pylon.InstantCamera, str]:
         """
-        Grab one image from a camera.
+        Check the grab arguments, then open the camera, start grabbing and
+        apply color settings and exposure time.
 
         Args:
             cam_iden: camera identifier related to the camera that has to grab the image
@@ -301,11 +878,12 @@ class BaslerHandler:
                            can be an int, indicating the exposure time in microseconds to apply
                            if 'auto', auto exposure is used
                            if None, it is set to 'auto'
+            gamma: gamma value applied by the camera
+            deadline: time.perf_counter() value at which auto exposure stops
 
         Returns:
-            result: a dictionary containing, the camera id, the exposure time, the grabbed image and the device info.
-                    The dictionary also contains a 'success' key, if it's false, an error occurred, and its description
-                    will be inserted in the 'error_msg' field.
+            the camera ready to retrieve images if no error occurred
+            an error message otherwise
         """
 
         # if needed set the default exposure time
@@ -319,8 +897,8 @@ class BaslerHandler:
         if error_msg is None and not isinstance(cam_iden, str):
             error_msg = f"cam_iden must be a string"
         if error_msg is None and not isinstance(exposure_time, int):
-            if not exposure_time in ["auto", "hdr", "default"]:
-                error_msg = f"exposure time must be an int value, or 'auto' or 'default'"  # or 'hdr'"
+            if not exposure_time in ["auto", "hdr", "default", "settled"]:
+                error_msg = f"exposure time must be an int value, or 'auto', 'hdr' or 'default'"
         # control on input ranges
         if error_msg is None and not (cam_iden in self._devices_info_configured.keys()):
 
@@ -333,81 +911,220 @@ class BaslerHandler:
         elif not camera.IsOpen():
             camera.Open()  # open the camera
 
-        # remove color correction
-        white_balancing(camera, False)
-        set_gamma(camera, gamma)
-        remove_autogain(camera)
-
         if error_msg is not None:
             self._log.error(error_msg)
-            return ImageBasler.init_error({"cam_iden": cam_iden}, error_msg)
+            return error_msg
 
+        # camera pixel format delivering the output pixel format
         device_info = self._devices_info_configured[cam_iden]
-        max_attempts = self._cfg.grab.max_attempts
+        try:
+            set_pixel_format(camera, device_info.get("pixel_format", "bgr"))
+        except Exception as e:
+            self._log.warning(f"Pixel format of camera {cam_iden} not set: {e}")
+
+        # remove color correction
+        white_balancing(camera, False)
+        set_gamma(camera, gamma)
+        remove_autogain(camera)
 
         # init
         if not camera.IsGrabbing():
             # start the grabbing
             camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
 
-        # set exposure
-        self._set_exposure(camera, exposure_time)  # set exposure time
-
-        # grab loop
-        n_attempts = 0
-        import time
-        
-        
-        while camera.IsGrabbing():
-
-            # wait for an image and then retrieve it.
-            grabResult = camera.RetrieveResult(
-                self._cfg.grab.timeout, pylon.TimeoutHandling_ThrowException
-            )
-
-            # image grabbed successfully?
-            if grabResult.GrabSucceeded():
-                img = self._converter.Convert(grabResult).GetArray()
-                grabResult.Release()
-
-                # log
-                if log:
-                    self._log.info(
-                        f"Grab successful: Cam: {cam_iden}, exposure_time: {str(exposure_time)}"
-                    )
-                break
+        # set exposure, keeping the auto exposure statistics for the image info
+        stats = self._set_exposure(camera, exposure_time, gamma, deadline)  # set exposure time
+        if stats is not None:
+            self._exposure_stats[cam_iden] = stats
 
+        return camera
 
-            #  if max attempts is exceeded, exit
-            elif n_attempts > max_attempts:
-                err_message = grabResult.GetErrorDescription() 
-                print()
-                self._log.error(error_msg)
-                return ImageBasler.init_error({"cam_iden": cam_iden}, "Max number of attempts exceeded, check internet connection: "+err_message)
-            else:
-                time.sleep(0.01)
+    @staticmethod
+    def _autoexposure_info(stats: dict) -> dict:
+        """
+        Image info keys of the auto exposure statistics
+        """
+        return {
+            "autoexposure_iterations": stats["iterations"],
+            "autoexposure_time_ms": stats["time_ms"],
+            "autoexposure_brightness": stats["brightness"],
+            "autoexposure_converged": stats["converged"],
+            "autoexposure_status": stats["status"],
+        }
 
-            # update number of attempts
-            n_attempts += 1
+    def _image_from_result(
+        self,
+        cam_iden: str,
+        camera: pylon.InstantCamera,
+        grabResult: pylon.GrabResult,
+        exposure_time: Union[int, str],
+        rotate: bool = True,
+    ) -> ImageBasler:
+        """
+        Convert a successful grab result into an ImageBasler object in the
+        output pixel format of the camera, adding the device info and applying
+        the configured rotation (if rotate is True)
+        """
 
+        device_info = self._devices_info_configured[cam_iden]
+        img, pixel_format, bayer_pattern = self._convert_result(
+            grabResult, device_info.get("pixel_format", "bgr"), self._frame_pool(cam_iden)
+        )
+        tick_timestamp = grabResult.GetTimeStamp()
         grabResult.Release()
+
         image_info = {
             "success": True,
             "cam_iden": cam_iden,
-            "autoexposure": exposure_time == "auto",
+            "autoexposure": exposure_time in ["auto", "settled"],
         }
         image_info.update(device_info)
+        image_info["pixel_format"] = pixel_format
+        if bayer_pattern is not None:
+            image_info["bayer_pattern"] = bayer_pattern
         image_info["exposure_time"] = get_exposure(camera)
+        image_info["tick_timestamp"] = tick_timestamp
+        if cam_iden in self._transfer_plan.keys():
+            image_info["transfer_planned_ms"] = self._transfer_plan[cam_iden]["end_ms"]
+        # the statistics of a concurrent auto exposure are shared by all the images of the capture
+        if exposure_time == "settled":
+            stats = self._exposure_stats.get(cam_iden, None)
+        else:
+            stats = self._exposure_stats.pop(cam_iden, None)
+        if stats is not None and image_info["autoexposure"]:
+            image_info.update(self._autoexposure_info(stats))
 
         image_basler = ImageBasler(image_info, img)
 
         # apply rotation
-        rotation_angle = device_info["rotation"]
-        if "rotation" in device_info.keys():
-            image_basler = image_basler.rotate_image(rotation_angle)
+        if rotate and "rotation" in device_info.keys():
+            image_basler = image_basler.rotate_image(device_info["rotation"])
         #
         return image_basler
 
+    @staticmethod
+    def _remaining_ms(deadline: float) -> float:
+        """
+        Milliseconds left before a deadline (time.perf_counter() value), infinite if None
+        """
+        if deadline is None:
+            return float("inf")
+        return (deadline - time.perf_counter()) * 1e3
+
+    def _timeout_error(self, cam_iden: str, stage: str) -> ImageBasler:
+        """
+        Failed image of a camera that ran out of latency budget, the stage is stored in timeout_stage
+        """
+        error_msg = f"Latency budget exceeded on camera {cam_iden}, stage: {stage}"
+        self._log.error(error_msg)
+        return ImageBasler.init_error(
+            {"cam_iden": cam_iden, "timeout_stage": stage}, error_msg
+        )
+
+    def _grab_basic(
+        self,
+        cam_iden: str,
+        exposure_time: Union[int, str] = None,
+        gamma: float = 0.5,
+        log=True,
+        deadline: float = None,
+    ) -> dict:
+        """
+        Grab one image from a camera.
+
+        Args:
+            cam_iden: camera identifier related to the camera that has to grab the image
+            exposure_time: exposure time used when acquiring images
+                           can be an int, indicating the exposure time in microseconds to apply
+                           if 'auto', auto exposure is used
+                           if 'hdr', an exposure bracket is grabbed and fused into one image
+                           if None, it is set to 'auto'
+            deadline: time.perf_counter() value at which the grab is abandoned,
+                      enforced on exposure setup, retries and conversion
+
+        Returns:
+            result: a dictionary containing, the camera id, the exposure time, the grabbed image and the device info.
+                    The dictionary also contains a 'success' key, if it's false, an error occurred, and its description
+                    will be inserted in the 'error_msg' field.
+        """
+
+        # the background acquisition of the camera waits for this grab
+        with self._acquisition_paused(cam_iden):
+
+            if self._remaining_ms(deadline) <= 0:
+                return self._timeout_error(cam_iden, "queued")
+
+            if exposure_time == "hdr":
+                return self._grab_hdr(cam_iden, gamma, deadline)
+
+            camera = self._prepare_camera(cam_iden, exposure_time, gamma, deadline)
+            if isinstance(camera, str):
+                return ImageBasler.init_error({"cam_iden": cam_iden}, camera)
+            if self._remaining_ms(deadline) <= 0:
+                return self._timeout_error(cam_iden, "exposure")
+
+            max_attempts = self._cfg.grab.max_attempts
+
+            # grab loop
+            n_attempts = 0
+            while camera.IsGrabbing():
+
+                # wait for an image and then retrieve it, within the budget
+                timeout = min(self._cfg.grab.timeout, self._remaining_ms(deadline))
+                if timeout <= 0:
+                    return self._timeout_error(cam_iden, "retrieve")
+                grabResult = camera.RetrieveResult(
+                    int(timeout), pylon.TimeoutHandling_Return
+                )
+                if grabResult is None or not grabResult.IsValid():
+                    if self._remaining_ms(deadline) <= 0:
+                        return self._timeout_error(cam_iden, "retrieve")
+                    error_msg = f"No image from camera {cam_iden} within {self._cfg.grab.timeout} ms"
+                    self._log.error(error_msg)
+                    return ImageBasler.init_error({"cam_iden": cam_iden}, error_msg)
+
+                # image grabbed successfully?
+                if grabResult.GrabSucceeded():
+
+                    # log
+                    if log:
+                        self._log.info(
+                            f"Grab successful: Cam: {cam_iden}, exposure_time: {str(exposure_time)}"
+                        )
+                    break
+
+
+                #  if max attempts is exceeded, exit
+                elif n_attempts > max_attempts:
+                    err_message = grabResult.GetErrorDescription() 
+                    grabResult.Release()
+                    self._log.error(err_message)
+                    return ImageBasler.init_error({"cam_iden": cam_iden}, "Max number of attempts exceeded, check internet connection: "+err_message)
+                else:
+                    grabResult.Release()
+                    time.sleep(max(0, min(0.01, self._remaining_ms(deadline) / 1e3)))
+
+                # update number of attempts
+                n_attempts += 1
+
+            # camera clock at the retrieval, for the achieved transfer time of scheduled cameras
+            retrieve_ticks = None
+            if cam_iden in self._transfer_plan.keys():
+                retrieve_ticks = camera_ticks(camera)
+
+            if self._remaining_ms(deadline) <= 0:
+                grabResult.Release()
+                return self._timeout_error(cam_iden, "convert")
+            image_basler = self._image_from_result(cam_iden, camera, grabResult, exposure_time)
+
+            # achieved transfer time, from the end of the exposure (the frame timestamp is its start)
+            if retrieve_ticks is not None:
+                exposure_ms = image_basler.image_info["exposure_time"] / 1e3
+                image_basler.image_info["transfer_ms"] = (
+                    retrieve_ticks - image_basler.image_info["tick_timestamp"]
+                ) / get_tick_frequency(camera) * 1e3 - exposure_ms
+            return image_basler
+
         # # Error handling
         # except genicam.GenericException as e:
         #     error_msg = f"An exception occurred: {e}"
@@ -415,6 +1132,205 @@ class BaslerHandler:
         #     return ImageBasler.init_error(device_info, error_msg)
         #
 
+    def _grab_triggered(
+        self,
+        cam_iden: str,
+        exposure_time: Union[int, str],
+        gamma: float,
+        barrier: threading.Barrier,
+        deadline: float = None,
+    ) -> Tuple[ImageBasler, float]:
+        """
+        Arm the software trigger of a camera, wait for all the other cameras
+        on the barrier, then trigger it and retrieve the image.
+        The barrier is always reached, also if an error occurred,
+        so that the other cameras are never blocked.
+        All the waits are bounded by the deadline (time.perf_counter() value).
+
+        Returns:
+            the grabbed image and the host time (perf_counter) of the trigger,
+            which is None if the camera has not been triggered
+        """
+
+        # the background acquisition of the camera waits for this grab
+        with self._acquisition_paused(cam_iden):
+
+            camera, error_msg, trigger_time = None, None, None
+            # stage that ran out of latency budget
+            stage = None
+
+            # arm the trigger
+            try:
+                camera = self._prepare_camera(cam_iden, exposure_time, gamma, deadline)
+                if isinstance(camera, str):
+                    error_msg, camera = camera, None
+                elif self._remaining_ms(deadline) <= 0:
+                    stage = "exposure"
+                else:
+                    camera.StopGrabbing()
+                    set_software_trigger(camera, True)
+                    camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
+                    timeout = min(
+                        self._cfg.grab.sync.trigger_ready_timeout,
+                        self._remaining_ms(deadline),
+                    )
+                    if not camera.WaitForFrameTriggerReady(
+                        int(max(0, timeout)), pylon.TimeoutHandling_Return
+                    ):
+                        if self._remaining_ms(deadline) <= 0:
+                            stage = "trigger_ready"
+                        else:
+                            error_msg = f"Camera {cam_iden} not ready for trigger"
+            except Exception as e:
+                error_msg = f"An exception occurred on camera {cam_iden}: {e}"
+
+            # fire all the cameras together
+            try:
+                timeout = min(self._cfg.grab.timeout, self._remaining_ms(deadline))
+                barrier.wait(max(0, timeout) / 1000)
+            except threading.BrokenBarrierError:
+                if error_msg is None and stage is None:
+                    if self._remaining_ms(deadline) <= 0:
+                        stage = "barrier"
+                    else:
+                        error_msg = f"Camera {cam_iden} not triggered, the other cameras were not ready"
+
+            try:
+                if error_msg is None and stage is None:
+                    t_start = time.perf_counter()
+                    camera.ExecuteSoftwareTrigger()
+                    trigger_time = (t_start + time.perf_counter()) / 2
+
+                    timeout = min(self._cfg.grab.timeout, self._remaining_ms(deadline))
+                    grabResult = camera.RetrieveResult(
+                        int(max(0, timeout)), pylon.TimeoutHandling_Return
+                    )
+                    retrieve_time = time.perf_counter()
+                    if grabResult is None or not grabResult.IsValid():
+                        if self._remaining_ms(deadline) <= 0:
+                            stage = "retrieve"
+                        else:
+                            error_msg = f"No image from camera {cam_iden} within {self._cfg.grab.timeout} ms"
+                    elif grabResult.GrabSucceeded():
+                        image_basler = self._image_from_result(
+                            cam_iden, camera, grabResult, exposure_time
+                        )
+                        # achieved transfer time, from the end of the exposure
+                        exposure_ms = image_basler.image_info["exposure_time"] / 1e3
+                        image_basler.image_info["transfer_ms"] = (
+                            retrieve_time - trigger_time
+                        ) * 1e3 - exposure_ms
+                    else:
+                        error_msg = "Triggered grab failed: " + grabResult.GetErrorDescription()
+                        grabResult.Release()
+            except Exception as e:
+                error_msg = f"An exception occurred on camera {cam_iden}: {e}"
+
+            # back to free run
+            if camera is not None:
+                try:
+                    camera.StopGrabbing()
+                    set_software_trigger(camera, False)
+                except Exception as e:
+                    self._log.warning(f"Trigger of camera {cam_iden} not restored: {e}")
+
+        if stage is not None:
+            return self._timeout_error(cam_iden, stage), None
+        if error_msg is not None:
+            self._log.error(error_msg)
+            return ImageBasler.init_error({"cam_iden": cam_iden}, error_msg), None
+        return image_basler, trigger_time
+
+    def _grab_synchronized(
+        self,
+        cam_idens: List[str],
+        exposure_time: List[Union[int, str]],
+        gamma: float,
+        timestamp: str,
+        deadline: float = None,
+    ) -> List[ImageBasler]:
+        """
+        Grab images triggering all the cameras at the same time, one shot for each exposure time.
+        The skew between the cameras is stored in the image info:
+            sync_skew_ms: spread of the host times at which the triggers were issued
+            sync_tick_skew_us: spread of the camera tick timestamps, available only
+                               if all the cameras are synchronized with PTP (IEEE 1588)
+        """
+
+        results = []
+        with ThreadPoolExecutor(max_workers=len(cam_idens)) as executor:
+            for exp in exposure_time:
+                barrier = threading.Barrier(len(cam_idens))
+                shots = list(
+                    executor.map(
+                        lambda c: self._grab_triggered(c, exp, gamma, barrier, deadline),
+                        cam_idens,
+                    )
+                )
+
+                # host side skew
+                trigger_times = [t for _, t in shots if t is not None]
+                skew_ms = None
+                if len(trigger_times) > 0:
+                    skew_ms = (max(trigger_times) - min(trigger_times)) * 1e3
+
+                # camera side skew, ticks are comparable only with ptp
+                tick_times = []
+                for image_basler, _ in shots:
+                    if image_basler.success():
+                        camera = self._get_cam_from_iden(image_basler.image_info["cam_iden"])
+                        if not ptp_enabled(camera):
+                            tick_times = []
+                            break
+                        tick_times.append(
+                            image_basler.image_info["tick_timestamp"]
+                            / get_tick_frequency(camera)
+                        )
+                tick_skew_us = None
+                if len(tick_times) > 0:
+                    tick_skew_us = (max(tick_times) - min(tick_times)) * 1e6
+
+                for image_basler, trigger_time in shots:
+                    if image_basler.success():
+                        image_basler.image_info["trigger_offset_ms"] = (
+                            trigger_time - min(trigger_times)
+                        ) * 1e3
+                        image_basler.image_info["sync_skew_ms"] = skew_ms
+                        image_basler.image_info["sync_tick_skew_us"] = tick_skew_us
+                    image_basler.image_info = {
+                        "timestamp": timestamp,
+                        **image_basler.image_info,
+                    }
+                    results.append(image_basler)
+
+                # planned and achieved time to transfer the frames of all the cameras
+                transfers = [
+                    (
+                        image_basler.image_info.get("transfer_planned_ms", None),
+                        image_basler.image_info["transfer_ms"],
+                    )
+                    for image_basler, _ in shots
+                    if image_basler.success()
+                ]
+                planned = [p for p, _ in transfers if p is not None]
+                if len(transfers) > 0:
+                    self._log.info(
+                        f"Synchronized grab, transfer time: {max([a for _, a in transfers]):.0f} ms"
+                        + (f" (planned {max(planned):.0f} ms)" if len(planned) > 0 else "")
+                    )
+
+                if skew_ms is not None:
+                    self._log.info(
+                        f"Synchronized grab, trigger skew: {skew_ms:.3f} ms"
+                        + (
+                            f", tick skew: {tick_skew_us:.1f} us"
+                            if tick_skew_us is not None
+                            else ""
+                        )
+                    )
+
+        return results
+
     def _load_configured_cams(self) -> bool:
         """
         Load the cameras that have been configured previously
@@ -440,13 +1356,34 @@ class BaslerHandler:
 
                 self._n_devices_configured = len(self._devices_info_configured)
 
-
+            self._build_cam_index()
             return True
         else:
             self._devices_info_configured = {}
             self._n_devices_configured = len(self._devices_info_configured)
+            self._build_cam_index()
             return False
 
+    def _match_key(self, device_info: dict) -> tuple:
+        """
+        Values of the match keys of a device, identifying the same camera across sessions
+        """
+        return tuple([device_info.get(key, None) for key in self._cfg.match_keys])
+
+    def _build_cam_index(self) -> None:
+        """
+        Index the cameras of the session by match keys and by identifier,
+        it must be rebuilt when the devices are enumerated or the configuration changes
+        """
+        self._slot_by_key = {
+            self._match_key(d): d["cam_idx"] for d in self._devices_info_current.values()
+        }
+        self._slot_by_iden = {}
+        for cam_iden, cam_info in self._devices_info_configured.items():
+            slot = self._slot_by_key.get(self._match_key(cam_info), None)
+            if slot is not None:
+                self._slot_by_iden[cam_iden] = slot
+
     def _get_cam_from_iden(self, cam_iden: str) -> Union[pylon.InstantCamera, str]:
         """
         Get the camera object from the given id
@@ -468,13 +1405,10 @@ class BaslerHandler:
         if err_msg is not None:
             return err_msg
 
-        # get configured infos
-        cam_info = self._devices_info_configured[cam_iden]
-
-        # find the match of info in the current devices
-        for _, d in self._devices_info_current.items():
-            if all([d[key] == cam_info[key] for key in self._cfg.match_keys]):
-                return self._cam_array[d["cam_idx"]]
+        # camera slot of the configured camera in the current devices
+        slot = self._slot_by_iden.get(cam_iden, None)
+        if slot is not None:
+            return self._cam_array[slot]
 
         return f"The configured camera '{cam_iden}' is not available"
 
@@ -494,12 +1428,365 @@ class BaslerHandler:
         else:
             return True
 
+    def _settle_autoexposure(
+        self, cam_idens: List[str], gamma: float, deadline: float = None
+    ) -> None:
+        """
+        Run the auto exposure of all the cameras at the same time, with a shared deadline.
+        It returns when every camera has converged or the deadline expired,
+        the status of each camera is kept for the image info.
+        """
+
+        start = time.perf_counter()
+        settle_deadline = start + self._cfg.grab.autoexposure.deadline / 1000
+        if deadline is not None:
+            settle_deadline = min(settle_deadline, deadline)
+
+        def settle(cam_iden: str) -> None:
+            error_msg = None
+            with self._acquisition_paused(cam_iden):
+                try:
+                    camera = self._prepare_camera(cam_iden, "auto", gamma, settle_deadline)
+                    if isinstance(camera, str):
+                        error_msg = camera
+                except Exception as e:
+                    error_msg = f"An exception occurred on camera {cam_iden}: {e}"
+            if error_msg is not None:
+                self._log.error(error_msg)
+                self._exposure_stats[cam_iden] = {
+                    "iterations": 0,
+                    "time_ms": (time.perf_counter() - start) * 1e3,
+                    "brightness": None,
+                    "converged": False,
+                    "status": "error",
+                }
+
+        with ThreadPoolExecutor(max_workers=len(cam_idens)) as executor:
+            list(executor.map(settle, cam_idens))
+
+        statuses = {
+            c: self._exposure_stats.get(c, {}).get("status", None) for c in cam_idens
+        }
+        self._log.info(
+            f"Auto exposure settled in {(time.perf_counter() - start) * 1e3:.0f} ms: {statuses}"
+        )
+
+    def _schedule_transfers(self, cam_idens: List[str], synchronized: bool = False) -> Dict[str, dict]:
+        """
+        Plan the transfers of the cameras of a capture over the shared link, and configure the cameras.
+        A camera grabbing alone gets the delays of previous schedules removed.
+        Background acquisitions are paused, since changing the packet size stops the grabbing.
+        Cameras that can not be opened are left out, their grab reports the error.
+
+        Args:
+            cam_idens: cameras of the capture
+            synchronized: True if the cameras are triggered together
+
+        Returns:
+            the transfer plan of each camera, empty if the transfers are not scheduled
+        """
+
+        cams = {}
+        for cam_iden in cam_idens:
+            camera = self._get_cam_from_iden(cam_iden)
+            if isinstance(camera, str):
+                continue
+            try:
+                if not camera.IsOpen():
+                    camera.Open()
+            except Exception as e:
+                self._log.warning(f"Transfer of camera {cam_iden} not scheduled: {e}")
+                continue
+            cams[cam_iden] = camera
+        try:
+            with ExitStack() as stack:
+                for cam_iden in cams.keys():
+                    stack.enter_context(self._acquisition_paused(cam_iden))
+                return self._bandwidth.schedule(cams, synchronized)
+        except Exception as e:
+            self._log.warning(f"Transfers not scheduled: {e}")
+            return {}
+
+    def _reset_transfers(self, cam_idens: List[str]) -> None:
+        """
+        Remove the delays of the schedule of a capture from cameras that keep grabbing alone
+        """
+        cams = {}
+        for cam_iden in cam_idens:
+            camera = self._get_cam_from_iden(cam_iden)
+            if not isinstance(camera, str) and camera.IsOpen():
+                cams[cam_iden] = camera
+        self._bandwidth.reset(cams)
+
+    def _grab_sequence(
+        self,
+        cam_iden: str,
+        exposure_time: List[Union[int, str]],
+        gamma: float,
+        timestamp: str,
+        deadline: float = None,
+    ) -> List[ImageBasler]:
+        """
+        Grab a sequence of images from a single camera, one for each exposure time.
+        Exceptions are returned as failed ImageBasler objects, so that a camera
+        can not break the grab of the other ones.
+        """
+
+        results = []
+        for exp in exposure_time:
+            try:
+                image_basler = self._grab_basic(cam_iden, exp, gamma, deadline=deadline)
+            except Exception as e:
+                error_msg = f"An exception occurred on camera {cam_iden}: {e}"
+                self._log.error(error_msg)
+                image_basler = ImageBasler.init_error({"cam_iden": cam_iden}, error_msg)
+            image_basler.image_info = {
+                "timestamp": timestamp,
+                **image_basler.image_info,
+            }
+            results.append(image_basler)
+        return results
+
+    def _acquire_burst(
+        self,
+        camera: pylon.InstantCamera,
+        exposure_time: List[Union[int, str]],
+        deadline: float = None,
+    ) -> Tuple[List[pylon.GrabResult], str, str]:
+        """
+        Acquire the frames of a burst without converting them, the camera must be prepared
+
+        Returns:
+            the grab results, to be released by the caller, the burst mode (continuous, sequencer
+            or triggered) and the stage that ran out of latency budget (None if all the frames arrived)
+        """
+
+        n = len(exposure_time)
+
+        # one buffer for each frame, allocated when grabbing starts
+        camera.StopGrabbing()
+        max_num_buffer = camera.MaxNumBuffer.Value
+        camera.MaxNumBuffer.Value = max(n, max_num_buffer)
+
+        mode = "continuous"
+        if len(set(exposure_time)) > 1:
+            mode = "sequencer"
+            if not self._cfg.grab.burst.sequencer or not set_sequencer(camera, exposure_time):
+                mode = "triggered"
+                set_software_trigger(camera, True)
+
+        grab_results = []
+        try:
+            camera.StartGrabbingMax(n, pylon.GrabStrategy_OneByOne)
+            for i in range(n):
+                if mode == "triggered":
+                    set_exposure(camera, exposure_time[i])
+                    camera.WaitForFrameTriggerReady(
+                        self._cfg.grab.sync.trigger_ready_timeout,
+                        pylon.TimeoutHandling_ThrowException,
+                    )
+                    camera.ExecuteSoftwareTrigger()
+
+                timeout = min(self._cfg.grab.timeout, self._remaining_ms(deadline))
+                grabResult = camera.RetrieveResult(
+                    int(max(0, timeout)), pylon.TimeoutHandling_Return
+                )
+                if grabResult is None or not grabResult.IsValid():
+                    return grab_results, mode, "retrieve"
+                grab_results.append(grabResult)
+        except:
+            for grabResult in grab_results:
+                grabResult.Release()
+            raise
+        finally:
+            camera.StopGrabbing()
+            camera.MaxNumBuffer.Value = max_num_buffer
+            if mode == "sequencer":
+                reset_sequencer(camera)
+            elif mode == "triggered":
+                set_software_trigger(camera, False)
+
+        return grab_results, mode, None
+
+    def _grab_burst(
+        self,
+        cam_iden: str,
+        exposure_time: List[Union[int, str]],
+        gamma: float,
+        timestamp: str,
+        deadline: float = None,
+    ) -> List[ImageBasler]:
+        """
+        Grab a burst of images from a single camera, one for each exposure time, back to back.
+        A grab buffer is allocated for each image before the burst, the grab results are held
+        until the burst is complete and converted only then.
+        Frames are acquired by continuous grabbing if the exposure time is the same for all
+        the images, otherwise by the camera sequencer, or by software triggers if the camera
+        has no sequencer. The achieved frame interval is stored in the image info (burst_interval_ms).
+        """
+
+        n = len(exposure_time)
+        grab_results, mode, stage, error_msg = [], None, None, None
+
+        with self._acquisition_paused(cam_iden):
+            camera = None
+            if self._remaining_ms(deadline) <= 0:
+                stage = "queued"
+            else:
+                try:
+                    camera = self._prepare_camera(cam_iden, exposure_time[0], gamma, deadline)
+                    if isinstance(camera, str):
+                        error_msg, camera = camera, None
+                    elif self._remaining_ms(deadline) <= 0:
+                        stage = "exposure"
+                    else:
+                        grab_results, mode, stage = self._acquire_burst(
+                            camera, exposure_time, deadline
+                        )
+                except Exception as e:
+                    error_msg = f"An exception occurred on camera {cam_iden}: {e}"
+                    self._log.error(error_msg)
+
+            # convert after the burst
+            results = []
+            for i, grabResult in enumerate(grab_results):
+                if grabResult.GrabSucceeded():
+                    image_basler = self._image_from_result(
+                        cam_iden, camera, grabResult, exposure_time[i]
+                    )
+                    # the camera reports the exposure of the last frame only
+                    if isinstance(exposure_time[i], int):
+                        image_basler.image_info["exposure_time"] = exposure_time[i]
+                    image_basler.image_info["burst_mode"] = mode
+                    image_basler.image_info["burst_index"] = i
+                else:
+                    frame_error = f"Error: {grabResult.ErrorCode} {grabResult.ErrorDescription}"
+                    grabResult.Release()
+                    self._log.error(frame_error)
+                    image_basler = ImageBasler.init_error({"cam_iden": cam_iden}, frame_error)
+                results.append(image_basler)
+            for _ in range(n - len(results)):
+                if error_msg is not None:
+                    results.append(ImageBasler.init_error({"cam_iden": cam_iden}, error_msg))
+                else:
+                    results.append(self._timeout_error(cam_iden, stage))
+
+        # achieved frame interval, from the camera timestamps
+        ticks = [
+            (r.image_info["burst_index"], r.image_info["tick_timestamp"])
+            for r in results
+            if r.success()
+        ]
+        if len(ticks) > 1:
+            interval_ms = (ticks[-1][1] - ticks[0][1]) / (ticks[-1][0] - ticks[0][0])
+            interval_ms *= 1e3 / get_tick_frequency(camera)
+            for image_basler in results:
+                if image_basler.success():
+                    image_basler.image_info["burst_interval_ms"] = interval_ms
+            self._log.info(
+                f"Burst of camera {cam_iden} ({mode}): {len(ticks)} frames, interval: {interval_ms:.1f} ms"
+            )
+
+        for image_basler in results:
+            image_basler.image_info = {
+                "timestamp": timestamp,
+                **image_basler.image_info,
+            }
+        return results
+
+    def _grab_hdr(
+        self, cam_iden: str, gamma: float, deadline: float = None
+    ) -> ImageBasler:
+        """
+        Grab an exposure bracket around the auto exposure time as a burst, and fuse it into one image.
+        The requested exposure times of the bracket (grab.hdr.stops in the config file, not rounded
+        by the camera) and the fusion time are stored in the image info.
+        """
+
+        cfg = self._cfg.grab.hdr
+        camera = self._prepare_camera(cam_iden, "hdr", gamma, deadline)
+        if isinstance(camera, str):
+            return ImageBasler.init_error({"cam_iden": cam_iden}, camera)
+        if self._remaining_ms(deadline) <= 0:
+            return self._timeout_error(cam_iden, "exposure")
+        stats = self._exposure_stats.pop(cam_iden, None)
+
+        base = get_exposure(camera)
+        # requested exposure times, within the camera range but not rounded to the camera increment
+        bracket = [clamp_exposure(base * 2**stop) for stop in cfg.stops]
+        grab_results, mode, stage = self._acquire_burst(camera, bracket, deadline)
+
+        # convert after the burst
+        frames = []
+        for grabResult in grab_results:
+            if grabResult.GrabSucceeded():
+                frames.append(
+                    self._image_from_result(cam_iden, camera, grabResult, "hdr", rotate=False)
+                )
+            else:
+                grabResult.Release()
+        if stage is not None:
+            return self._timeout_error(cam_iden, stage)
+        if len(frames) < len(bracket):
+            error_msg = f"HDR bracket of camera {cam_iden} incomplete, {len(frames)} of {len(bracket)} frames"
+            self._log.error(error_msg)
+            return ImageBasler.init_error({"cam_iden": cam_iden}, error_msg)
+        if self._remaining_ms(deadline) <= 0:
+            return self._timeout_error(cam_iden, "fusion")
+
+        start = time.perf_counter()
+        fused = fuse_exposures(
+            [f.image for f in frames],
+            method=cfg.fusion,
+            contrast=cfg.weights.contrast,
+            saturation=cfg.weights.saturation,
+            exposure=cfg.weights.exposure,
+            weights_scale=cfg.weights_scale,
+        )
+        fusion_ms = (time.perf_counter() - start) * 1e3
+        for f in frames:
+            f.release()
+
+        # the fused image keeps the info of the frame at the center of the bracket
+        stops = list(cfg.stops)
+        center = min(range(len(stops)), key=lambda i: abs(stops[i]))
+        image_info = dict(frames[center].image_info)
+        image_info.pop("bayer_pattern", None)
+        image_info["pixel_format"] = "mono8" if fused.ndim == 2 else "bgr"
+        image_info["autoexposure"] = True
+        if stats is not None:
+            image_info.update(self._autoexposure_info(stats))
+        image_info["exposure_time"] = bracket[center]
+        image_info["hdr_exposures"] = bracket
+        image_info["hdr_stops"] = stops
+        image_info["hdr_fusion"] = cfg.fusion
+        image_info["hdr_fusion_ms"] = fusion_ms
+        image_info["burst_mode"] = mode
+        ticks = [f.image_info["tick_timestamp"] for f in frames]
+        if len(ticks) > 1:
+            image_info["burst_interval_ms"] = (
+                (ticks[-1] - ticks[0]) / (len(ticks) - 1) * 1e3 / get_tick_frequency(camera)
+            )
+        self._log.info(
+            f"HDR of camera {cam_iden}: exposures {bracket} us, fusion ({cfg.fusion}): {fusion_ms:.0f} ms"
+        )
+
+        image_basler = ImageBasler(image_info, fused)
+        device_info = self._devices_info_configured[cam_iden]
+        if "rotation" in device_info.keys():
+            image_basler = image_basler.rotate_image(device_info["rotation"])
+        return image_basler
+
     def _grab_images_from_cams(
         self,
         number_of_images: int = 1,
         exposure_time: Union[int, List[int]] = None,
         gamma: float = 0.5,
         cam_idens: Union[str, List[str]] = None,
+        parallel: bool = None,
+        sync: bool = None,
+        budget_ms: float = None,
+        burst: bool = None,
     ) -> List[Dict]:
         """
         Grab one or multiple images with one or more cameras
@@ -515,6 +1802,15 @@ class BaslerHandler:
                      it can be a string, indicating a camera identifier
                      it can be a list of strings, indicating multiple cameras
                      if None, all available cameras will be involved
+            parallel: if True, each camera is grabbed by its own worker thread
+                      if None, grab.parallel in the config file is used
+            sync: if True, all the cameras are triggered at the same time with a software trigger
+                  if None, grab.sync.enabled in the config file is used
+            budget_ms: latency budget of the capture in ms, the cameras that do not finish in time
+                       return an error with the stage that ran out of time (timeout_stage)
+                       if None, grab.budget_ms in the config file is used (null for no budget)
+            burst: if True, the images of each camera are grabbed back to back and converted after the burst
+                   if None, grab.burst.enabled in the config file is used
 
         Returns:
             results: The grab result, which is a list of dictionaries.
@@ -527,8 +1823,12 @@ class BaslerHandler:
         # log
         self._log.info("Grabbing images...")
 
-        # load devices
-        self._load_devices()
+        # deadline of the capture
+        if budget_ms is None:
+            budget_ms = self._cfg.grab.budget_ms
+        deadline = None
+        if budget_ms is not None:
+            deadline = time.perf_counter() + budget_ms / 1000
 
         # control on number of images
         error_msg = None
@@ -547,6 +1847,11 @@ class BaslerHandler:
             error_msg = f"Exposure time list has not same length {len(exposure_time)} of number of images ({number_of_images})"
             self._log.error(error_msg)
             return error_msg
+        # 'settled' is set only by the concurrent auto exposure
+        if "settled" in exposure_time:
+            error_msg = f"exposure time must be an int value, or 'auto', 'hdr' or 'default'"
+            self._log.error(error_msg)
+            return error_msg
 
         # set cam ids
         if cam_idens is None:
@@ -554,18 +1859,111 @@ class BaslerHandler:
         if cam_idens.__class__ != list:
             cam_idens = [cam_idens]
 
-        # grab images
-        results = []
-        data = itertools.product(list(range(number_of_images)), cam_idens)
-        timestamp = str(datetime.datetime.now())[:-7]
-        for j, cam_iden in data:
-            image_basler = self._grab_basic(cam_iden, exposure_time[j], gamma)
-            image_basler.image_info = {
-                "timestamp": timestamp,
-                **image_basler.image_info,
-            }
-            results.append(image_basler)
-        self._stop_cams()
+        # parallel grab needs distinct cameras
+        distinct = len(set(cam_idens)) == len(cam_idens)
+        if parallel is None:
+            parallel = self._cfg.grab.parallel
+        parallel = parallel and len(cam_idens) > 1 and distinct
+        if sync is None:
+            sync = self._cfg.grab.sync.enabled
+        # hdr images are bursts of their own
+        sync = sync and distinct and "hdr" not in exposure_time
+        if burst is None:
+            burst = self._cfg.grab.burst.enabled
+        # bracketed bursts need a fixed exposure time for each image
+        fixed = len(set(exposure_time)) == 1 or all([isinstance(e, int) for e in exposure_time])
+        burst = burst and number_of_images > 1 and distinct and not sync and fixed
+        burst = burst and "hdr" not in exposure_time
+
+        # auto exposure of all the cameras converging together, before grabbing
+        settle = self._cfg.grab.autoexposure.concurrent and len(cam_idens) > 1
+        settle = settle and distinct
+        settle = settle and all([e in [None, "auto"] for e in exposure_time])
+
+        # wait for the other captures within the budget
+        timeout = -1 if deadline is None else max(0, self._remaining_ms(deadline)) / 1000
+        if not self._lock.acquire(timeout=timeout):
+            timestamp = str(datetime.datetime.now())[:-7]
+            results = []
+            for j, cam_iden in itertools.product(range(number_of_images), cam_idens):
+                image_basler = self._timeout_error(cam_iden, "lock")
+                image_basler.image_info = {"timestamp": timestamp, **image_basler.image_info}
+                results.append(image_basler)
+            return results
+
+        try:
+
+            # load devices, reusing the opened session if possible
+            self._ensure_devices(cam_idens)
+
+            if settle:
+                self._settle_autoexposure(cam_idens, gamma, deadline)
+                exposure_time = ["settled"] * number_of_images
+
+            # cameras sharing the link transfer their frames without overrunning it,
+            # a single camera transfers at full speed
+            self._transfer_plan = self._schedule_transfers(list(set(cam_idens)), sync)
+
+            timestamp = str(datetime.datetime.now())[:-7]
+            if sync:
+
+                # all the cameras triggered together
+                results = self._grab_synchronized(
+                    cam_idens, exposure_time, gamma, timestamp, deadline
+                )
+
+            elif parallel or burst:
+
+                # one worker for each camera, all the cameras are grabbing at once
+                grab = self._grab_burst if burst else self._grab_sequence
+                workers = len(cam_idens) if parallel else 1
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    sequences = list(
+                        executor.map(
+                            lambda c: grab(c, exposure_time, gamma, timestamp, deadline),
+                            cam_idens,
+                        )
+                    )
+
+                # keep the order of the sequential grab
+                results = [
+                    sequences[i][j]
+                    for j, i in itertools.product(
+                        range(number_of_images), range(len(cam_idens))
+                    )
+                ]
+
+            else:
+
+                # grab images
+                results = []
+                data = itertools.product(list(range(number_of_images)), cam_idens)
+                for j, cam_iden in data:
+                    results += self._grab_sequence(
+                        cam_iden, [exposure_time[j]], gamma, timestamp, deadline
+                    )
+
+            # background acquisitions resume at full speed
+            if len(self._transfer_plan) > 0:
+                self._reset_transfers([c for c in self._transfer_plan.keys() if c in self._acquisitions])
+
+            self._release_cams()
+
+        finally:
+            # the statistics of the concurrent auto exposure are shared only by the images of this capture
+            if settle:
+                for cam_iden in cam_idens:
+                    self._exposure_stats.pop(cam_iden, None)
+            self._lock.release()
+
+        # partial result, the cameras that ran out of time
+        timed_out = [
+            r.image_info["cam_iden"] for r in results if "timeout_stage" in r.image_info
+        ]
+        if len(timed_out) > 0:
+            self._log.warning(
+                f"Latency budget of {budget_ms} ms exceeded, partial result without cameras {timed_out}"
+            )
 
         self._log.info("Grab completed\n")
 
@@ -575,6 +1973,29 @@ class BaslerHandler:
     ################ PUBLIC ################
     ########################################
 
+    def flush(self) -> None:
+        """
+        Wait until all the captured images have been written to disk
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self) -> None:
+        """
+        Write the pending images, then stop and close all the cameras of the session
+        """
+        if self._writer is not None:
+            self._writer.close()
+        self._qrcode_stage.close()
+        self._results.close()
+        with self._lock:
+            self._stop_acquisitions()
+            if self._cam_array is not None:
+                self._stop_cams()
+                for cam in self._cam_array:
+                    cam.DestroyDevice()
+                self._cam_array = None
+
     def set_default_rotation(self, cam_iden: str, rotation_angle: int) -> dict:
         with open(self._cfg.data.path_json, "r") as f:
             data = json.load(f)
@@ -600,9 +2021,9 @@ class BaslerHandler:
         if cam_iden not in data.keys():
             return {"error: ": f"Camera iden {cam_iden} not found"}
 
-        if not isinstance(exposure_time, int) and exposure_time != "auto":
+        if not isinstance(exposure_time, int) and exposure_time not in ["auto", "hdr"]:
             return {
-                "error: ": f"exposure_time value must be an int, or the string 'auto'",
+                "error: ": f"exposure_time value must be an int, or the strings 'auto' or 'hdr'",
             }
 
         data[cam_iden]["exposure_time"] = exposure_time
@@ -611,6 +2032,42 @@ class BaslerHandler:
             json.dump(data, f, indent=4)
         return {}
 
+    def set_default_encoding(
+        self, cam_iden: str, encoding: str, quality: int = None
+    ) -> dict:
+        with open(self._cfg.data.path_json, "r") as f:
+            data = json.load(f)
+        if cam_iden not in data.keys():
+            return {"error: ": f"Camera iden {cam_iden} not found"}
+        if encoding not in encodings.keys():
+            return {
+                "error: ": f"encoding value must be one of {list(encodings.keys())}",
+            }
+        if quality is not None and not isinstance(quality, int):
+            return {
+                "error: ": f"quality value must be an int",
+            }
+        data[cam_iden]["encoding"] = encoding
+        data[cam_iden]["encoding_quality"] = quality
+        with open(self._cfg.data.path_json, "w") as f:
+            json.dump(data, f, indent=4)
+        return {}
+
+    def set_default_pixel_format(self, cam_iden: str, pixel_format: str) -> dict:
+        with open(self._cfg.data.path_json, "r") as f:
+            data = json.load(f)
+        if cam_iden not in data.keys():
+            return {"error: ": f"Camera iden {cam_iden} not found"}
+        if pixel_format not in pixel_formats:
+            return {
+                "error: ": f"pixel_format value must be one of {pixel_formats}",
+            }
+        data[cam_iden]["pixel_format"] = pixel_format
+        with open(self._cfg.data.path_json, "w") as f:
+            json.dump(data, f, indent=4)
+        self._drop_frame_pools([cam_iden])
+        return {}
+
     def change_camera_iden(self, old_iden: str, new_iden: str) -> dict:
         if any([c in new_iden for c in forbidden_chars_win]):
             return {
@@ -623,13 +2080,10 @@ class BaslerHandler:
             return {"error: ": f"Camera iden {old_iden} not found"}
 
         # substitute results
-        img_info = self.get_all_img_info()
-        if old_iden in img_info.keys():
-            img_info[new_iden] = img_info.pop(old_iden)
-            for d in img_info[new_iden]:
-                d["cam_iden"] = new_iden
-            with open(self._cfg.results.path_json, "w") as f:
-                json.dump(img_info, f, indent=4)
+        self.flush()
+        self._results.rename(old_iden, new_iden)
+        self._frames.rename(old_iden, new_iden)
+        self._drop_frame_pools([old_iden])
 
         data[new_iden] = data.pop(old_iden)
         with open(self._cfg.data.path_json, "w") as f:
@@ -640,8 +2094,11 @@ class BaslerHandler:
         """
         Clear the results directory
         """
-        shutil.rmtree(self._cfg.results.dir, ignore_errors=True)
-        shutil.rmtree(self._cfg.results.path_json, ignore_errors=True)
+        self.flush()
+        self._qrcode_stage.flush()
+        self._frames.clear()
+        self._results.clear()
+        shutil.rmtree(os.path.join(self._cfg.results.dir, "images"), ignore_errors=True)
         self._log.info("Captured images removed from disk\n")
 
     def configure_cameras(self) -> None:
@@ -659,18 +2116,19 @@ class BaslerHandler:
         self._load_configured_cams()
         devices_info_old = self._devices_info_configured
 
-        # load devices
-        self._load_devices()
+        # load devices, new cameras may have been connected
+        self._load_devices(force=True)
 
         # new devices info
-        devices_info_configured = self._devices_info_current
+        devices_info_configured = dict(self._devices_info_current)
 
         # find matched devices with old configuration
+        iden_by_key = {self._match_key(d): k for k, d in devices_info_old.items()}
         replace_dict = {}
-        for k_old, d_old in devices_info_old.items():
-            for k_new, d_new in devices_info_configured.items():
-                if all([d_old[key] == d_new[key] for key in self._cfg.match_keys]):
-                    replace_dict[k_new] = k_old
+        for k_new, d_new in devices_info_configured.items():
+            k_old = iden_by_key.get(self._match_key(d_new), None)
+            if k_old is not None:
+                replace_dict[k_new] = k_old
 
         for k_new, k_old in replace_dict.items():
             info_new = devices_info_configured.pop(k_new)
@@ -679,7 +2137,7 @@ class BaslerHandler:
                 if k in self._cfg.camera_info:
                     new_dict[k] = v
                 else:
-                    new_dict[k] = devices_info_old[k_old][k]
+                    new_dict[k] = devices_info_old[k_old].get(k, v)
             devices_info_configured[k_old] = new_dict
 
         # save devices configured to the json file
@@ -699,6 +2157,21 @@ class BaslerHandler:
     def get_cameras_info(self) -> dict:
         return self._devices_info_configured
 
+    def get_frame_pool_stats(self) -> dict:
+        """
+        Hits and misses of the frame buffer pool of each camera, with the buffers held and in use
+        """
+        with self._frame_pools_lock:
+            return {
+                cam_iden: pool.stats() for cam_iden, pool in self._frame_pools.items()
+            }
+
+    def get_parameter_cache_stats(self) -> dict:
+        """
+        Number of camera parameter writes issued and skipped because the value did not change
+        """
+        return param_cache.stats()
+
     def log_cameras(self) -> None:
         """
         Logs information of available devices, both configured cameras and current ones
@@ -755,56 +2228,111 @@ class BaslerHandler:
             False or True wether an error occurred or not
         """
 
-        # load devices
-        self._load_devices()
-
-        camera = self._get_cam_from_iden(cam_iden)
-
-        # handle errors
-        if isinstance(camera, str):
-            self._log.error(camera)
+        # frames come from the background acquisition shared with the other viewers
+        r = self._open_stream(cam_iden)
+        if isinstance(r, str):
+            self._log.error(r)
             return False
 
-        if not camera.IsOpen():
-            camera.Open()  # open the camera
-        # self._set_exposure(camera, exposure_time) # set exposure time
-        if not camera.IsGrabbing():
-            # start the grabbing
-            camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
-
-        # set fps
-        self._set_fps(camera, self._cfg.grab.fps)
-
-        # streaming loop
-        self._log.info(f"Image stream started (camera: {cam_iden})")
-        image_name = f"Stream of camera: {cam_iden}"
-        cv2.namedWindow(image_name, cv2.WINDOW_NORMAL)
-        cv2.resizeWindow(image_name, 800, 800)
-        self._grab_basic(cam_iden, exposure_time, log=False)
-        while True:
-            image_basler = self._grab_basic(cam_iden, "default", log=False)
-
-            # handle errors
-            if image_basler.success() is False:
-                self._log.error(image_basler.error_msg)
-                break
-
-            cv2.imshow(image_name, image_basler.image)
-            key = cv2.waitKey(1)
-            if key == ord("q"):
-                self._stop_cams()
-                cv2.destroyAllWindows()
-                break
+        try:
+            if exposure_time is not None:
+                self._grab_basic(cam_iden, exposure_time, log=False)
+
+            # streaming loop
+            self._log.info(f"Image stream started (camera: {cam_iden})")
+            image_name = f"Stream of camera: {cam_iden}"
+            cv2.namedWindow(image_name, cv2.WINDOW_NORMAL)
+            cv2.resizeWindow(image_name, 800, 800)
+            acquisition = self._acquisitions[cam_iden]
+            count = 0
+            while True:
+                image_basler, count = acquisition.wait_frame(
+                    count, self._cfg.acquisition.first_frame_timeout / 1000
+                )
+
+                # handle errors
+                if image_basler is None:
+                    self._log.error(
+                        acquisition.error_msg() or f"No frames from camera {cam_iden}"
+                    )
+                    break
+
+                cv2.imshow(image_name, image_basler.image)
+                key = cv2.waitKey(1)
+                if key == ord("q"):
+                    break
+            cv2.destroyAllWindows()
+        finally:
+            self._close_stream(cam_iden)
         self._log.info(f"Image stream ended (camera: {cam_iden})\n")
 
         return True
 
+    def stream(
+        self,
+        cam_iden: str,
+        scale: float = None,
+        fps: float = None,
+        quality: int = None,
+    ) -> Generator[bytes, None, None]:
+        """
+        Generate the JPEG frames of a live stream of a camera.
+        All the viewers of a camera share its background acquisition, which is
+        started with the first viewer and stopped with the last one, unless it
+        was already running. Viewers using the same settings share the encoded frames.
+
+        Args:
+            cam_iden: The identifier of the camera
+            scale: resolution scaling, if None stream.scale in the config file is used
+            fps: frame rate cap, if None stream.fps in the config file is used
+            quality: JPEG quality, if None stream.quality in the config file is used
+
+        Returns:
+            a generator of JPEG encoded frames, it ends if the acquisition stops
+        """
+
+        scale = self._cfg.stream.scale if scale is None else scale
+        fps = self._cfg.stream.fps if fps is None else fps
+        quality = self._cfg.stream.quality if quality is None else quality
+        min_interval = 1 / fps if fps > 0 else 0
+
+        r = self._open_stream(cam_iden)
+        if isinstance(r, str):
+            self._log.error(r)
+            return
+
+        try:
+            acquisition = self._acquisitions[cam_iden]
+            count = 0
+            next_time = time.monotonic()
+            while True:
+                image_basler, count = acquisition.wait_frame(
+                    count, self._cfg.acquisition.first_frame_timeout / 1000
+                )
+                if image_basler is None:
+                    break
+                yield self._stream_encode(cam_iden, image_basler, count, scale, quality)
+
+                # frame rate cap
+                next_time = max(next_time + min_interval, time.monotonic())
+                time.sleep(max(0, next_time - time.monotonic()))
+        finally:
+            self._close_stream(cam_iden)
+
     def capture(
         self,
         number_of_images: int = 1,
         exposure_time: Union[int, List[int]] = None,
         gamma: float = 0.5,
         cam_idens: Union[str, List[str]] = None,
+        parallel: bool = None,
+        sync: bool = None,
+        encoding: str = None,
+        encoding_quality: int = None,
+        qrcodes: bool = None,
+        wait_qrcodes: bool = False,
+        budget_ms: float = None,
+        burst: bool = None,
     ) -> List[ImageBasler]:
         """
         Grab one or multiple images with one or more cameras, and store them in the results directory
@@ -814,12 +2342,31 @@ class BaslerHandler:
             exposure_time: exposure time used when acquiring images
                            can be an int, indicating the exposure time in microseconds to apply
                            can be a list of ints, indicating the exposure time for each image (length must match with number of images)
+                           if 'hdr', an exposure bracket around the auto exposure time is fused into one image
                            if None, it is set to 'auto'
             cam_idens: The camera identifiers related to the cameras we want to use to grab images
                     it can be a string, indicating a camera identifier
                      it can be a list of strings, indicating multiple cameras
                      if None, all available cameras will be involved
                      Run log_cameras() to see the camera identifiers.
+            parallel: if True, cameras are grabbed concurrently
+                      if None, grab.parallel in the config file is used
+            sync: if True, cameras are triggered at the same time, the trigger skew is stored in the image info
+                  if None, grab.sync.enabled in the config file is used
+            encoding: output encoding, one of 'png', 'jpeg', 'webp', 'tiff', 'npy'
+                      if None, the encoding of the camera in camera_data.json is used,
+                      or results.encoding in the config file
+            encoding_quality: compression level (0-9) for png, quality (0-100) for jpeg and webp
+            qrcodes: if True, the qrcodes of the images are decoded in background after the capture
+                     if None, qrcode.stage.enabled in the config file is used
+            wait_qrcodes: if True, wait for the decoded qrcodes, available in the qrcodes attribute of the images
+            budget_ms: latency budget of the grab in ms, when it runs out the cameras that finished
+                       are returned, the others fail with the stage that ran out of time in 'timeout_stage'
+                       if None, grab.budget_ms in the config file is used (null for no budget)
+            burst: if True, the images of each camera are grabbed back to back, with the camera
+                   sequencer if the exposure times differ, and converted after the burst;
+                   the achieved frame interval is stored in 'burst_interval_ms'
+                   if None, grab.burst.enabled in the config file is used
 
         Returns:
             results: The grab result, which is a list of ImageBasler objects.
@@ -832,21 +2379,53 @@ class BaslerHandler:
         if isinstance(cam_idens, str):
             cam_idens = [cam_idens]
 
+        if encoding is not None and encoding not in encodings.keys():
+            error_msg = f"Invalid encoding {encoding}, available encodings: {list(encodings.keys())}"
+            self._log.error(error_msg)
+            return error_msg
+
         # grab
         results = self._grab_images_from_cams(
             number_of_images=number_of_images,
             exposure_time=exposure_time,
             cam_idens=cam_idens,
             gamma=gamma,
+            parallel=parallel,
+            sync=sync,
+            budget_ms=budget_ms,
+            burst=burst,
         )
+        if isinstance(results, str):
+            return results
 
-        # save images in the results
+        if qrcodes is None:
+            qrcodes = self._cfg.qrcode.stage.enabled
+        qrcodes = qrcodes or wait_qrcodes
+
+        # save images in the results, in background if the writer is enabled
+        futures = []
         for i, image_basler in enumerate(results):
             #if image_basler.success():
-            cam_iden = cam_idens[i]
-            image_basler.save(
-                self._cfg.results.path_json, self._cfg.results.max_result_num
-            )
+            if image_basler.success():
+                image_basler.set_encoding(
+                    *self._get_encoding(
+                        image_basler.image_info["cam_iden"], encoding, encoding_quality
+                    )
+                )
+            # decode the qrcodes in background, keyed by the image path
+            if qrcodes and image_basler.success():
+                image_basler.set_image_path()
+                futures.append(self._qrcode_stage.submit(image_basler))
+            if self._writer is not None:
+                self._writer.submit(image_basler, self._results)
+            else:
+                image_basler.save(self._results)
+            self._frames.put(image_basler)
+
+        if wait_qrcodes:
+            for future in futures:
+                if future is not None:
+                    future.result()
 
         #     # resize result number
         #     data = json.load(f)
@@ -861,24 +2440,146 @@ class BaslerHandler:
         #     json.dump(data, f, indent=4)
         #
 
+        return results
+
+    def start_background_acquisition(self, cam_iden: str) -> Union[bool, str]:
+        """
+        Start acquiring continuously from a camera in background, so that
+        snapshot() returns the last frame without waiting for a grab.
+        The exposure time and gamma configured for the camera are used.
+
+        Returns:
+            True if the acquisition is running, an error message otherwise
+        """
+
+        with self._lock:
+            self._ensure_devices([cam_iden])
+            acquisition = self._acquisitions.get(cam_iden, None)
+            if acquisition is not None and acquisition.running():
+                return True
+            r = self._start_acquisition(cam_iden)
+            if isinstance(r, str):
+                self._log.error(r)
+            return r
+
+    def stop_background_acquisition(self, cam_iden: str) -> None:
+        with self._lock:
+            acquisition = self._acquisitions.pop(cam_iden, None)
+            if acquisition is not None:
+                acquisition.stop()
+
+    def snapshot(self, cam_iden: str) -> ImageBasler:
+        """
+        Get the most recent frame of a camera from its background acquisition,
+        which is started if it is not running. The frame is not saved.
+
+        Returns:
+            the ImageBasler object, its info contain the age of the frame in milliseconds (age_ms)
+        """
+
+        acquisition = self._acquisitions.get(cam_iden, None)
+        if acquisition is None or not acquisition.running():
+            r = self.start_background_acquisition(cam_iden)
+            if isinstance(r, str):
+                return ImageBasler.init_error({"cam_iden": cam_iden}, r)
+            acquisition = self._acquisitions[cam_iden]
+
+        frame, age_ms = acquisition.latest(
+            timeout=self._cfg.acquisition.first_frame_timeout / 1000
+        )
+        if frame is None:
+            error_msg = acquisition.error_msg()
+            if error_msg is None:
+                error_msg = f"No frames from camera {cam_iden}"
+            return ImageBasler.init_error({"cam_iden": cam_iden}, error_msg)
+
+        return frame.copy({**frame.image_info, "age_ms": age_ms})
+
+    def decode_qrcodes(self, image_basler: ImageBasler) -> dict:
+        """
+        Decode the qrcodes of an image, inside the qrcode regions of interest
+        of its camera (qr_rois in camera_data.json)
+        """
+        cam_iden = image_basler.image_info.get("cam_iden", None)
+        rois = self._devices_info_configured.get(cam_iden, {}).get("qr_rois", None)
+        return self.qrcodes.decode(image_basler.gray(), rois)
+
+    def get_qrcodes(self, cam_iden: str, wait: bool = True) -> dict:
+        """
+        Qrcodes of the last image captured by a camera. They are looked up in
+        the results if the image has already been decoded, otherwise the image
+        is decoded and its qrcodes are stored.
+
+        Args:
+            cam_iden: the camera identifier
+            wait: if True, wait for the decode of the image, if it is in progress
+
+        Returns:
+            the qrcodes ('qrcodes' key), or an error message ('error' key),
+            'pending' is True if the decode is in progress and wait is False
+        """
+
+        image_basler = self.get_last_image(cam_iden)
+        if image_basler is None:
+            return {"error": f"No images with camera {cam_iden}"}
+        if not image_basler.success():
+            return image_basler.image_info
+
+        image_path = image_basler.image_info.get("image_path", None)
+        if not wait and self._qrcode_stage.is_pending(image_path):
+            return {"qrcodes": None, "pending": True}
+        qr_list = self._qrcode_stage.get(image_path)
+        if qr_list is None:
+            qr_list = self.decode_qrcodes(image_basler)["qrcodes"]
+            if image_path is not None:
+                self._results.set_qrcodes(image_path, cam_iden, qr_list)
+        return {"qrcodes": qr_list}
+
     def get_all_img_info(self) -> dict:
-        with open(self._cfg.results.path_json, "r") as f:
-            data = json.load(f)
-        return data
+        self.flush()
+        return self._results.all()
 
     def get_last_img_info(self, cam_iden: str) -> bool:
         """
         get info about all the collected images in the results directory
         """
 
-        # load json file
-        with open(self._cfg.results.path_json, "r") as f:
-            data = json.load(f)
+        # last image info, from memory if cached
+        image_basler = self._frames.get(cam_iden)
+        if image_basler is not None:
+            return image_basler.image_info
 
-        if cam_iden not in data.keys():
+        # otherwise once the pending images are written
+        self.flush()
+        image_info = self._results.last(cam_iden)
+
+        if image_info is None:
             return {"error": f"No images with camera {cam_iden}"}
 
-        return data[cam_iden][-1]
+        return image_info
+
+    def get_last_image(self, cam_iden: str) -> ImageBasler:
+        """
+        get the last image captured by a camera, from memory if cached, from disk otherwise
+
+        Returns:
+            the ImageBasler object, None if there are no images of the camera
+        """
+
+        image_basler = self._frames.get(cam_iden)
+        if image_basler is not None:
+            return image_basler
+
+        self.flush()
+        image_info = self._results.last(cam_iden)
+        if image_info is None:
+            return None
+        if image_info["success"]:
+            image_basler = ImageBasler.load(image_info)
+        else:
+            image_basler = ImageBasler(image_info, None)
+        self._frames.put(image_basler)
+        return image_basler
 
     # def log_images_info(self) -> bool:
     #     """
@@ -914,14 +2615,14 @@ class BaslerHandler:
         show images stored in the results directory
         """
         # check if results are stored
-        if not os.path.exists(self._cfg.results.path_json):
+        data = self.get_all_img_info()
+        if len(data) == 0:
             self._log.info("No results stored yet\n")
             return False
-        # load json file
-        with open(self._cfg.results.path_json, "r") as f:
-            data = json.load(f)
         # show images
-        for d in data:
+        for d in itertools.chain(*data.values()):
+            if not d["success"]:
+                continue
             img_basler = ImageBasler.load(d)
             img_basler.show_img()
         cv2.waitKey(0)
@@ -1,14 +1,118 @@
 from pypylon import pylon, genicam
+from collections import defaultdict
+import threading
+import time
 
 
+class ParameterCache:
+    """
+    Last values written to the nodes of each camera.
+    A node is written only if its value changed, since on GigE cameras
+    every node access is a network round trip.
+
+    The values of a camera must be invalidated when the camera reconnects
+    or a feature file is loaded, and a node must be forgotten when the camera
+    starts changing it by itself (e.g. ExposureTime with ExposureAuto on).
+    """
+
+    def __init__(self) -> None:
+        self._values = defaultdict(dict)
+        # values read back after the writes, the camera may round the written value
+        self._applied = defaultdict(dict)
+        self._lock = threading.Lock()
+        self.writes_issued = 0
+        self.writes_skipped = 0
+
+    @staticmethod
+    def _key(camera: pylon.InstantCamera) -> str:
+        return camera.GetDeviceInfo().GetSerialNumber()
+
+    def write(
+        self, camera: pylon.InstantCamera, node: str, value, read_back: bool = False
+    ) -> bool:
+        """
+        Write a node if its cached value is different
+
+        Args:
+            read_back: read the node after the write, for nodes rounded by the camera
+                       (e.g. to their increment), so that read() returns the applied value
+
+        Returns:
+            True if the node has been written, False if the write was skipped
+        """
+        key = self._key(camera)
+        with self._lock:
+            if node in self._values[key] and self._values[key][node] == value:
+                self.writes_skipped += 1
+                return False
+        getattr(camera, node).Value = value
+        applied = getattr(camera, node).Value if read_back else value
+        with self._lock:
+            self._values[key][node] = value
+            self._applied[key][node] = applied
+            self.writes_issued += 1
+        return True
+
+    def read(self, camera: pylon.InstantCamera, node: str, store: bool = False):
+        """
+        Read a node, from the cache if it has been written
+
+        Args:
+            store: keep the value read from the camera in the cache, only for nodes
+                   that the camera does not change by itself
+        """
+        key = self._key(camera)
+        with self._lock:
+            if node in self._applied[key]:
+                return self._applied[key][node]
+        value = getattr(camera, node).Value
+        if store:
+            with self._lock:
+                self._values[key][node] = value
+                self._applied[key][node] = value
+        return value
+
+    def forget(self, camera: pylon.InstantCamera, *nodes: str) -> None:
+        """
+        Remove nodes from the cache, their values are no longer known
+        """
+        key = self._key(camera)
+        with self._lock:
+            for node in nodes:
+                self._values[key].pop(node, None)
+                self._applied[key].pop(node, None)
+
+    def invalidate(self, camera: pylon.InstantCamera = None) -> None:
+        """
+        Remove all the cached values of a camera, or of all the cameras if None
+        """
+        with self._lock:
+            if camera is None:
+                self._values.clear()
+                self._applied.clear()
+            else:
+                self._values.pop(self._key(camera), None)
+                self._applied.pop(self._key(camera), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "writes_issued": self.writes_issued,
+                "writes_skipped": self.writes_skipped,
+            }
+
+
+# parameter cache shared by all the cameras
+param_cache = ParameterCache()
+
 def set_auto_target(camera: pylon.InstantCamera, target: int):
 
     try:
         val = max(int(target*255),50)
-        camera.AutoTargetValue.Value = val
+        param_cache.write(camera, "AutoTargetValue", val)
     except:
         try:
-            camera.AutoTargetBrightness.Value = target
+            param_cache.write(camera, "AutoTargetBrightness", target)
         except:
             #import ipdb; ipdb.set_trace()
             pass
@@ -18,9 +122,9 @@ def white_balancing(camera: pylon.InstantCamera, on: bool):
 
     try:
         if on:
-            camera.BalanceWhiteAuto.Value = "Continuous"
+            param_cache.write(camera, "BalanceWhiteAuto", "Continuous")
         else:
-            camera.BalanceWhiteAuto.Value = "Off"
+            param_cache.write(camera, "BalanceWhiteAuto", "Off")
     except:
         pass
     pass
@@ -28,9 +132,9 @@ def white_balancing(camera: pylon.InstantCamera, on: bool):
 
 def set_gamma(camera: pylon.InstantCamera, gamma: float):
     try:
-        camera.GammaSelector.Value = "User"
-        camera.GammaEnable.Value = True
-        camera.Gamma.Value = gamma
+        param_cache.write(camera, "GammaSelector", "User")
+        param_cache.write(camera, "GammaEnable", True)
+        param_cache.write(camera, "Gamma", gamma)
     except:
         pass
     
@@ -38,91 +142,335 @@ def set_gamma(camera: pylon.InstantCamera, gamma: float):
 
 def remove_autogain(camera: pylon.InstantCamera):
     try:
-        camera.GainAuto.Value = "Off"
+        param_cache.write(camera, "GainAuto", "Off")
     except:
         pass
 
     try:
-        camera.Gain.Value = 0
+        param_cache.write(camera, "Gain", 0)
     except:
         try:
-            camera.GainRaw.Value = 0
+            param_cache.write(camera, "GainRaw", 0)
         except:
             pass
 
 
-def set_autoexposure(
-    camera: pylon.InstantCamera,
-    brightness_val: int,
-    timeout: int,
-):
+# camera pixel formats delivering each output pixel format, bgr images are
+# demosaiced on the host from bayer buffers, a third of the size of BGR8 buffers
+bayer_pixel_formats = ["BayerRG8", "BayerBG8", "BayerGR8", "BayerGB8"]
+camera_pixel_formats = {
+    "mono8": ["Mono8"],
+    "bayer": bayer_pixel_formats,
+    "bgr": bayer_pixel_formats,
+}
+
+
+def set_pixel_format(camera: pylon.InstantCamera, pixel_format: str) -> None:
     """
-    Set auto exposure and gain to reach a target brightness value
+    Set the camera pixel format that delivers the output pixel format without conversions,
+    the camera pixel format is kept if the camera does not support any of them
+    (e.g. bayer on a mono camera). The current pixel format is cached, so the camera
+    is accessed only when the pixel format changes.
     """
+    current = param_cache.read(camera, "PixelFormat", store=True)
+    if current in camera_pixel_formats[pixel_format]:
+        return
+    available = camera.PixelFormat.Symbolics
+    candidates = [f for f in camera_pixel_formats[pixel_format] if f in available]
+    if len(candidates) == 0:
+        return
+    # the pixel format can not be changed while grabbing
+    if camera.IsGrabbing():
+        camera.StopGrabbing()
+    param_cache.write(camera, "PixelFormat", candidates[0])
 
-    # camera.BslLightSourcePreset.Value = "Off"
-    # minLowerLimit = camera.AutoExposureTimeLowerLimit.Min
-    # maxUpperLimit = camera.AutoExposureTimeUpperLimit.Max
-    # camera.AutoExposureTimeLowerLimit.Value = minLowerLimit
-    # camera.AutoExposureTimeUpperLimit.Value = maxUpperLimit
-    #
+
+def start_autoexposure(camera: pylon.InstantCamera, brightness_val: int):
+    """
+    Let the camera adjust continuously its exposure to reach a target brightness value
+    """
 
     set_auto_target(camera, brightness_val)
     # camera.AutoFunctionROISelector.Value = "ROI1"
     # camera.AutoFunctionProfile.Value = "MinimizeExposureTime"
-    camera.ExposureAuto.Value = "Continuous"
+    param_cache.write(camera, "ExposureAuto", "Continuous")
+    param_cache.forget(camera, "ExposureTime", "ExposureTimeAbs")
     # camera.GainAuto.Value = "Continuous"
     # camera.BslColorSpace.Value = "Off"
-    converter = pylon.ImageFormatConverter()
-    converter.OutputPixelFormat = pylon.PixelType_BGR8packed
-    for i in range(12):
-        grabResult = camera.RetrieveResult(
-            timeout, pylon.TimeoutHandling_ThrowException
-        )
-        if grabResult.GrabSucceeded():
-            img = converter.Convert(grabResult).GetArray()
-            brightness = img.mean() / 255
-            # print(brightness)
-            # print(brightness)
-
-            # # custom thresholding
-            # if abs(brightness - brightness_val) < brightness_thresh:
-            #     camera.ExposureAuto.Value = "Off"
-            #     camera.GainAuto.Value = "Off"
-            #     break
-            #
-    # camera.BslLightSourcePresetFeatureEnable.Value = False
-    # camera.BslColorSpace.Value = "sRgb"
+
+
+def raw_brightness(grabResult: pylon.GrabResult, step: int = 8) -> float:
+    """
+    Mean brightness in [0, 1] of a grab result, measured on the raw buffer
+    subsampled with the given step, without any pixel format conversion.
+    The 2x2 cell at each sampled position is averaged, so on Bayer buffers
+    all the sites of the color filter (R, G, G, B) are weighted equally,
+    whatever the step.
+    """
+    max_val = 2 ** pylon.BitDepth(grabResult.GetPixelType()) - 1
+    with grabResult.GetArrayZeroCopy() as img:
+        sites = [img[o::step, p::step].mean() for o in (0, 1) for p in (0, 1)]
+        return float(sum(sites) / 4) / max_val
+
+
+# last converged exposure time of each camera, starting point of the next autoexposure
+_converged_exposure = {}
+
+
+def set_autoexposure(
+    camera: pylon.InstantCamera,
+    brightness_val: float,
+    timeout: int,
+    tolerance: float = 0.02,
+    max_iterations: int = 12,
+    settle_frames: int = 2,
+    step: int = 8,
+    gamma: float = 1.0,
+    deadline: float = None,
+) -> dict:
+    """
+    Adjust the exposure time until the image brightness is within tolerance of a target value.
+    It starts from the last converged exposure time of the camera, and at each
+    iteration the exposure is scaled by the ratio between target and measured
+    brightness, corrected by the gamma applied by the camera.
+
+    Args:
+        camera: a grabbing camera
+        brightness_val: target brightness in [0, 1]
+        timeout: ms to wait for a frame
+        tolerance: maximum distance from the target brightness to stop
+        max_iterations: maximum number of exposure updates
+        settle_frames: frames discarded after each update, acquired with the previous exposure time
+        step: subsampling step of the raw buffer used to measure the brightness
+        gamma: gamma applied by the camera
+        deadline: time.perf_counter() value at which the adjustment stops, None for no deadline
+
+    Returns:
+        a dictionary with the number of iterations, the time taken in ms,
+        the last measured brightness, if it converged and the final status:
+        'converged', 'max_iterations', 'timeout' or 'grab_failed'
+        (max_iterations failed frames, e.g. incomplete frames)
+    """
+
+    start = time.perf_counter()
+    key = camera.GetDeviceInfo().GetSerialNumber()
+
+    def retrieve() -> pylon.GrabResult:
+        t = timeout
+        if deadline is not None:
+            t = int(min(timeout, max(0, deadline - time.perf_counter()) * 1000))
+        return camera.RetrieveResult(t, pylon.TimeoutHandling_Return)
+
+    # warm start
+    exposure_time = _converged_exposure.get(key, None)
+    if exposure_time is None:
+        exposure_time = get_exposure(camera)
+    set_exposure(camera, exposure_time)
+
+    brightness, status, iterations, failed = None, "max_iterations", 0, 0
+    while iterations < max_iterations:
+
+        # frames exposed before the last update, then the frame to measure
+        for i in range(settle_frames + 1):
+            grabResult = retrieve()
+            if grabResult is None or not grabResult.IsValid():
+                status = "timeout"
+                break
+            if i < settle_frames:
+                grabResult.Release()
+        if status == "timeout":
+            break
+
+        if not grabResult.GrabSucceeded():
+            grabResult.Release()
+            failed += 1
+            if failed >= max_iterations:
+                status = "grab_failed"
+                break
+            continue
+        brightness = raw_brightness(grabResult, step)
+        grabResult.Release()
+
+        if abs(brightness - brightness_val) <= tolerance:
+            status = "converged"
+            break
+
+        # brightness grows with exposure^gamma
+        if brightness < 1e-3:
+            factor = 4
+        else:
+            factor = (brightness_val / brightness) ** (1 / gamma)
+        factor = min(max(factor, 0.25), 4)
+        exposure_time = clamp_exposure(exposure_time * factor)
+        set_exposure(camera, exposure_time)
+        iterations += 1
+
+    if status == "converged":
+        _converged_exposure[key] = exposure_time
+
+    return {
+        "iterations": iterations,
+        "time_ms": (time.perf_counter() - start) * 1e3,
+        "brightness": brightness,
+        "converged": status == "converged",
+        "status": status,
+    }
 
 
 def get_exposure(camera: pylon.InstantCamera):
     try:
-        exposure_time = camera.ExposureTime.Value
+        exposure_time = param_cache.read(camera, "ExposureTime")
     except:
-        exposure_time = camera.ExposureTimeAbs.Value
+        exposure_time = param_cache.read(camera, "ExposureTimeAbs")
     return exposure_time
 
 
+def clamp_exposure(exposure_time: float) -> int:
+    """
+    Exposure time in microseconds within the range accepted by the cameras
+    """
+    return int(min(max(30, exposure_time), 999999))
+
+
 def set_exposure(camera: pylon.InstantCamera, exposure_time: int):
     """
     set_exposure time for a camera
     """
 
-    exposure_time = min(max(30, exposure_time), 999999)
-    camera.ExposureAuto.Value = "Off"
-    camera.GainAuto.Value = "Off"
+    exposure_time = clamp_exposure(exposure_time)
+    param_cache.write(camera, "ExposureAuto", "Off")
+    param_cache.write(camera, "GainAuto", "Off")
+    # the camera rounds the exposure time to its increment
     try:
-        if camera.ExposureTime.Value != exposure_time:
-            camera.ExposureTime.Value = exposure_time
+        param_cache.write(camera, "ExposureTime", exposure_time, read_back=True)
     except:
-        if camera.ExposureTimeAbs.Value != exposure_time:
-            camera.ExposureTimeAbs.Value = exposure_time
+        param_cache.write(camera, "ExposureTimeAbs", exposure_time, read_back=True)
 
     # camera.BslLightSourcePreset.Value = "Off"
     # camera.BslLightSourcePresetFeatureEnable.Value = False
     # camera.BslColorSpace.Value = "sRgb"
 
 
+def set_software_trigger(camera: pylon.InstantCamera, on: bool) -> None:
+    """
+    Switch the frame start of a camera between software trigger and free run.
+    The camera must not be grabbing.
+    """
+    camera.TriggerSelector.Value = "FrameStart"
+    if on:
+        camera.TriggerSource.Value = "Software"
+        camera.TriggerMode.Value = "On"
+    else:
+        camera.TriggerMode.Value = "Off"
+
+
+def set_sequencer(camera: pylon.InstantCamera, exposure_times: list) -> bool:
+    """
+    Program the sequencer of a camera with one set for each exposure time, the camera
+    moves to the next set at every frame, so a bracketed burst needs no writes between frames.
+    The camera must not be grabbing.
+
+    Returns:
+        True if the sequencer is on, False if the camera has no sequencer (or not enough sets)
+    """
+    try:
+        if len(exposure_times) > camera.SequencerSetSelector.Max + 1:
+            return False
+        sources = camera.SequencerTriggerSource.Symbolics
+        source = [s for s in ["FrameStart", "ExposureActive", "ExposureStart"] if s in sources][0]
+        param_cache.write(camera, "SequencerMode", "Off")
+    except:
+        return False
+
+    param_cache.write(camera, "ExposureAuto", "Off")
+    param_cache.write(camera, "SequencerConfigurationMode", "On")
+    for i, exposure_time in enumerate(exposure_times):
+        camera.SequencerSetSelector.Value = i
+        camera.ExposureTime.Value = clamp_exposure(exposure_time)
+        camera.SequencerPathSelector.Value = 0
+        camera.SequencerSetNext.Value = (i + 1) % len(exposure_times)
+        camera.SequencerTriggerSource.Value = source
+        camera.SequencerSetSave.Execute()
+    param_cache.write(camera, "SequencerConfigurationMode", "Off")
+    camera.SequencerSetStart.Value = 0
+    param_cache.write(camera, "SequencerMode", "On")
+
+    # the exposure time now changes at every frame
+    param_cache.forget(camera, "ExposureTime")
+    return True
+
+
+def reset_sequencer(camera: pylon.InstantCamera) -> None:
+    """
+    Switch off the sequencer of a camera, if it has one.
+    The camera must not be grabbing.
+    """
+    try:
+        param_cache.write(camera, "SequencerMode", "Off")
+    except:
+        pass
+    param_cache.forget(camera, "ExposureTime")
+
+
+def ptp_enabled(camera: pylon.InstantCamera) -> bool:
+    """
+    True if the camera clock is synchronized with PTP (IEEE 1588),
+    only in this case tick timestamps of different cameras can be compared
+    """
+    try:
+        return camera.GevIEEE1588.Value
+    except:
+        try:
+            return camera.PtpEnable.Value
+        except:
+            return False
+
+
+def get_tick_frequency(camera: pylon.InstantCamera) -> float:
+    """
+    Frequency in Hz of the camera clock used for the timestamps
+    """
+    try:
+        return camera.GevTimestampTickFrequency.Value
+    except:
+        # ace 2 and ace USB cameras count nanoseconds
+        return 1e9
+
+
+def camera_ticks(camera: pylon.InstantCamera) -> int:
+    """
+    Current value of the camera clock, latched with a node access
+
+    Returns:
+        the ticks, None if the clock can not be latched
+    """
+    try:
+        try:
+            camera.TimestampLatch.Execute()
+            return camera.TimestampLatchValue.Value
+        except:
+            camera.GevTimestampControlLatch.Execute()
+            return camera.GevTimestampValue.Value
+    except:
+        return None
+
+
+def camera_boot_time(camera: pylon.InstantCamera) -> float:
+    """
+    Host time (seconds since the epoch) at which the camera clock started, i.e. when the camera
+    was powered on or reset and lost the features written to it. It costs a couple of node accesses.
+
+    Returns:
+        the boot time, None if it is not known (the clock is synchronized with PTP or it can not be read)
+    """
+    if ptp_enabled(camera):
+        return None
+    ticks = camera_ticks(camera)
+    if ticks is None:
+        return None
+    return time.time() - ticks / get_tick_frequency(camera)
+
+
 def set_fps(camera: pylon.InstantCamera, fps: int) -> None:
     """
     set fps rate for a camera
@@ -0,0 +1,296 @@
+import argparse
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from prettytable import PrettyTable
+from image_basler import ImageBasler, encode_image, rotation_codes
+from qrcode import QRCodeDetector
+from hdr import fuse_exposures, fusion_methods
+
+# frame sizes (height, width) of the cameras of the station
+frame_sizes = {
+    "acA5472-5gc": (3648, 5472),
+    "a2A2590-22gm": (1944, 2592),
+}
+
+
+def synthetic_frame(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """
+    BGR frame with smooth gradients, edges and sensor noise, so that it
+    compresses like a real frame and not like a flat or random image
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = 128 + 60 * np.sin(x / 300) * np.cos(y / 200)
+    base[(x // 400 + y // 400) % 2 == 0] += 40
+    frame = np.stack([base, base * 0.9, base * 1.1], axis=-1)
+    frame += rng.normal(0, 4, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def load_frames(image_paths: list) -> dict:
+    """
+    Frames to benchmark, real images if given, synthetic ones otherwise
+    """
+    if image_paths:
+        return {path: cv2.imread(path) for path in image_paths}
+    return {name: synthetic_frame(*size) for name, size in frame_sizes.items()}
+
+
+def time_it(fn, repeat: int) -> float:
+    """
+    Best time in milliseconds over the repetitions
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return min(times)
+
+
+def peak_alloc(fn) -> float:
+    """
+    Peak memory in MB allocated by a function
+    """
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def bench_rotation(args) -> None:
+    """
+    Time and allocations per capture of the eager rotation (cv2.rotate on every grabbed frame)
+    and of the lazy rotation (kept as metadata and applied by the outputs)
+    """
+
+    def eager(frame, output):
+        image = cv2.rotate(frame, rotation_codes[args.rotation])
+        if output == "encode":
+            encode_image(image, args.encoding)
+        elif output == "thumbnail":
+            image = cv2.resize(image, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+            encode_image(image, "jpeg", 70)
+        elif output == "view":
+            image.mean()
+
+    def lazy(frame, output):
+        image_basler = ImageBasler({"encoding": args.encoding}, frame)
+        image_basler.rotate_image(args.rotation)
+        if output == "encode":
+            image_basler.encode()
+        elif output == "thumbnail":
+            encode_image(image_basler.thumbnail(0.25), "jpeg", 70)
+        elif output == "view":
+            image_basler.image.mean()
+
+    for name, frame in load_frames(args.image).items():
+        table = PrettyTable()
+        table.field_names = [
+            "Output",
+            "Eager (ms)",
+            "Lazy (ms)",
+            "Eager alloc (MB)",
+            "Lazy alloc (MB)",
+        ]
+        for output in ["none", "view", "thumbnail", "encode"]:
+            table.add_row(
+                [
+                    output,
+                    f"{time_it(lambda: eager(frame, output), args.repeat):.1f}",
+                    f"{time_it(lambda: lazy(frame, output), args.repeat):.1f}",
+                    f"{peak_alloc(lambda: eager(frame, output)):.1f}",
+                    f"{peak_alloc(lambda: lazy(frame, output)):.1f}",
+                ]
+            )
+        print(f"{name} {frame.shape}, rotation {args.rotation}, encoding {args.encoding}")
+        print(table.get_string() + "\n")
+
+
+def qrcode_frame(height: int, width: int, texts: list, module_px: int = 6) -> np.ndarray:
+    """
+    Synthetic frame with a qrcode for each text, spread over the frame
+    """
+    frame = synthetic_frame(height, width)
+    encoder = cv2.QRCodeEncoder.create()
+    for i, text in enumerate(texts):
+        code = encoder.encode(text)
+        code = cv2.resize(
+            code, None, fx=module_px, fy=module_px, interpolation=cv2.INTER_NEAREST
+        )
+        code = cv2.copyMakeBorder(code, 24, 24, 24, 24, cv2.BORDER_CONSTANT, value=255)
+        y = (i * 2 + 1) * height // (2 * len(texts)) - code.shape[0] // 2
+        x = (i * 2 + 1) * width // (2 * len(texts)) - code.shape[1] // 2
+        frame[y : y + code.shape[0], x : x + code.shape[1]] = code[..., None]
+    return frame
+
+
+def bench_qrcode(args) -> None:
+    """
+    Latency and accuracy of the qrcode engines, on frames with known qrcodes
+    or on real frames (the expected codes are the union of the codes found by all the engines)
+    """
+
+    detector = QRCodeDetector(args.config)
+    if args.image:
+        frames = {path: (cv2.imread(path), None) for path in args.image}
+    else:
+        texts = [f"CHARGER-{i:04d}" for i in range(args.codes)]
+        frames = {
+            name: (qrcode_frame(*size, texts), set(texts))
+            for name, size in frame_sizes.items()
+        }
+
+    # the legacy engine searches the whole image
+    searches = [("zxing", False)] + [
+        (engine, pyramid) for engine in ["zxingcpp", "cv2"] for pyramid in [False, True]
+    ]
+
+    for name, (frame, expected) in frames.items():
+        found, times = {}, {}
+        for engine, pyramid in searches:
+            try:
+                found[engine, pyramid] = set(
+                    detector.detect_qrcodes(frame, engine, pyramid=pyramid)
+                )
+                times[engine, pyramid] = time_it(
+                    lambda: detector.detect_qrcodes(frame, engine, pyramid=pyramid),
+                    args.repeat,
+                )
+            except Exception as e:
+                print(f"{engine}: not available ({e})")
+        if expected is None:
+            expected = set().union(*found.values())
+
+        table = PrettyTable()
+        table.field_names = [
+            "Engine",
+            "Search",
+            "Time (ms)",
+            "Found",
+            "Expected",
+            "Missed",
+            "Wrong",
+        ]
+        for engine, pyramid in found.keys():
+            codes = found[engine, pyramid]
+            table.add_row(
+                [
+                    engine,
+                    "pyramid" if pyramid else "full",
+                    f"{times[engine, pyramid]:.1f}",
+                    len(codes & expected),
+                    len(expected),
+                    len(expected - codes),
+                    len(codes - expected),
+                ]
+            )
+        print(f"{name} {frame.shape}")
+        print(table.get_string() + "\n")
+
+
+def bracket(frame: np.ndarray, stops: list) -> list:
+    """
+    Exposure bracket simulated from a frame, scaling its intensity by 2**stop
+    """
+    return [
+        np.clip(frame.astype(np.float32) * 2**stop, 0, 255).astype(np.uint8)
+        for stop in stops
+    ]
+
+
+def bench_hdr(args) -> None:
+    """
+    Fusion time of an exposure bracket for each fusion method, against the frame size
+    """
+
+    for name, frame in load_frames(args.image).items():
+        table = PrettyTable()
+        table.field_names = ["Scale", "Size (MP)"] + [f"{m} (ms)" for m in fusion_methods]
+        for scale in args.scales:
+            resized = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            images = bracket(resized, args.stops)
+            row = [scale, f"{resized.shape[0] * resized.shape[1] / 1e6:.1f}"]
+            for method in fusion_methods:
+                ms = time_it(lambda: fuse_exposures(images, method), args.repeat)
+                row.append(f"{ms:.0f}")
+            table.add_row(row)
+        print(f"{name} {frame.shape}, stops {args.stops}")
+        print(table.get_string() + "\n")
+
+
+def bench_encoding(args) -> None:
+    """
+    Encode time and size of each encoding on the station frame sizes
+    """
+
+    # encodings and quality values to compare
+    settings = [
+        ("png", 0),
+        ("png", 1),
+        ("png", 3),
+        ("png", 9),
+        ("jpeg", 95),
+        ("jpeg", 80),
+        ("webp", 90),
+        ("webp", 101),  # lossless
+        ("tiff", None),
+        ("npy", None),
+    ]
+
+    for name, frame in load_frames(args.image).items():
+        table = PrettyTable()
+        table.field_names = ["Encoding", "Quality", "Time (ms)", "Size (MB)", "Ratio"]
+        raw_size = frame.nbytes
+        for encoding, quality in settings:
+            encoded = encode_image(frame, encoding, quality)
+            ms = time_it(lambda: encode_image(frame, encoding, quality), args.repeat)
+            table.add_row(
+                [
+                    encoding,
+                    quality,
+                    f"{ms:.1f}",
+                    f"{len(encoded) / 1e6:.2f}",
+                    f"{raw_size / len(encoded):.1f}",
+                ]
+            )
+        print(f"{name} {frame.shape}, raw size {raw_size / 1e6:.1f} MB")
+        print(table.get_string() + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the image pipeline")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of each measure")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    encoding_parser = subparsers.add_parser("encoding", help="encode time and size")
+    encoding_parser.add_argument("--image", nargs="*", help="real frames to encode")
+    encoding_parser.set_defaults(func=bench_encoding)
+
+    rotation_parser = subparsers.add_parser(
+        "rotation", help="eager and lazy rotation, per output of a capture"
+    )
+    rotation_parser.add_argument("--image", nargs="*", help="real frames to rotate")
+    rotation_parser.add_argument("--rotation", type=int, default=90, choices=[90, 180, 270])
+    rotation_parser.add_argument("--encoding", default="jpeg", help="encoding of the saved image")
+    rotation_parser.set_defaults(func=bench_rotation)
+
+    qrcode_parser = subparsers.add_parser("qrcode", help="qrcode engines latency and accuracy")
+    qrcode_parser.add_argument("--image", nargs="*", help="real frames with qrcodes")
+    qrcode_parser.add_argument("--codes", type=int, default=4, help="qrcodes in synthetic frames")
+    qrcode_parser.add_argument("--config", default="../config.yaml", help="config file")
+    qrcode_parser.set_defaults(func=bench_qrcode)
+
+    hdr_parser = subparsers.add_parser("hdr", help="exposure fusion time against frame size")
+    hdr_parser.add_argument("--image", nargs="*", help="real frames, the bracket is simulated")
+    hdr_parser.add_argument("--stops", type=float, nargs="*", default=[-2, 0, 2])
+    hdr_parser.add_argument(
+        "--scales", type=float, nargs="*", default=[0.25, 0.5, 1], help="frame size scales"
+    )
+    hdr_parser.set_defaults(func=bench_hdr)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+from image_basler import ImageBasler
+
+
+class FrameCache:
+    """
+    Last captured frame of each camera, kept in memory with its image info
+    and its encoded bytes, so it can be served without reading the disk.
+
+    The cache is bounded by max_bytes, counting the native, the demosaiced and
+    the encoded images: when the bound is exceeded, the least recently used
+    cameras are evicted.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(image_basler: ImageBasler) -> int:
+        return image_basler.nbytes()
+
+    def size(self) -> int:
+        """
+        Bytes currently held by the cache
+        """
+        with self._lock:
+            return sum([self._size(f) for f in self._frames.values()])
+
+    def put(self, image_basler: ImageBasler) -> None:
+        """
+        Store the last frame of a camera, evicting old frames if needed
+        """
+
+        cam_iden = image_basler.image_info["cam_iden"]
+        with self._lock:
+            self._frames[cam_iden] = image_basler
+            self._frames.move_to_end(cam_iden)
+
+            # evict the least recently used cameras, but never the new frame
+            total = sum([self._size(f) for f in self._frames.values()])
+            while total > self._max_bytes and len(self._frames) > 1:
+                _, evicted = self._frames.popitem(last=False)
+                total -= self._size(evicted)
+
+    def get(self, cam_iden: str) -> ImageBasler:
+        """
+        Last frame of a camera, None if it is not cached
+        """
+        with self._lock:
+            image_basler = self._frames.get(cam_iden, None)
+            if image_basler is not None:
+                self._frames.move_to_end(cam_iden)
+            return image_basler
+
+    def rename(self, old_iden: str, new_iden: str) -> None:
+        with self._lock:
+            if old_iden in self._frames.keys():
+                image_basler = self._frames.pop(old_iden)
+                image_basler.image_info["cam_iden"] = new_iden
+                self._frames[new_iden] = image_basler
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
@@ -0,0 +1,115 @@
+import threading
+import weakref
+import numpy as np
+from typing import Tuple
+
+
+class FrameLease:
+    """
+    Ownership of a pooled buffer. The arrays handed out by the pool are views
+    of the lease (their base), so the lease lives as long as any array derived
+    from the frame, and the buffer returns to its pool when the last one is gone.
+    """
+
+    __slots__ = ("_buffer", "__weakref__")
+
+    def __init__(self, buffer: np.ndarray) -> None:
+        self._buffer = buffer
+
+    @property
+    def __array_interface__(self) -> dict:
+        return self._buffer.__array_interface__
+
+
+class FramePool:
+    """
+    Preallocated output buffers of the frames of a camera, the conversion of
+    the grab results writes into them instead of allocating a new array for
+    each frame.
+
+    Every array handed out is a view of a FrameLease, numpy views of the array
+    (slices, the rotated view of ImageBasler.image, arrays returned by capture)
+    keep the lease alive through their base, so a buffer is reused only when
+    no array of the frame is left: ImageBasler.release() drops the arrays of
+    an image, otherwise they are dropped when garbage collected.
+
+    Frames of a camera have one shape at a time: when the shape changes
+    (pixel format, ROI), the buffers of the old shape are dropped.
+    """
+
+    def __init__(self, max_buffers: int = 4) -> None:
+        """
+        Args:
+            max_buffers: buffers owned by the pool, when all of them are
+                         in use new frames are allocated outside the pool
+        """
+        self._max_buffers = max_buffers
+        self._key = None
+        self._free = []
+        self._n_buffers = 0
+        # leases of older shapes, or given before clear(), do not return their buffers
+        self._generation = 0
+        # reentrant: the finalizers of the leases can run in a garbage collection
+        # triggered by an allocation of acquire, in the thread holding the lock
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, generation: int, buffer: np.ndarray) -> None:
+        with self._lock:
+            if generation == self._generation:
+                self._free.append(buffer)
+
+    def _reset(self) -> None:
+        self._free = []
+        self._n_buffers = 0
+        self._generation += 1
+
+    def acquire(self, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """
+        A free buffer with the given shape, allocated if none is free
+
+        Returns:
+            the buffer, as a view of its lease if it is owned by the pool
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            if key != self._key:
+                self._reset()
+                self._key = key
+            if len(self._free) > 0:
+                self.hits += 1
+                buffer = self._free.pop()
+            else:
+                self.misses += 1
+                buffer = np.empty(shape, dtype)
+                if self._n_buffers >= self._max_buffers:
+                    return buffer
+                self._n_buffers += 1
+            generation = self._generation
+
+        lease = FrameLease(buffer)
+        weakref.finalize(lease, self._put, generation, buffer)
+        return np.asarray(lease)
+
+    def clear(self) -> None:
+        """
+        Drop all the buffers, the ones in use are freed with their arrays
+        """
+        with self._lock:
+            self._key = None
+            self._reset()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = 0
+            if self._key is not None:
+                size = self._n_buffers * np.dtype(self._key[1]).itemsize
+                size *= int(np.prod(self._key[0]))
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "buffers": self._n_buffers,
+                "in_use": self._n_buffers - len(self._free),
+                "mb": size / 1e6,
+            }
@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+from typing import List
+
+# exposure fusion methods
+fusion_methods = ["mertens", "fast"]
+
+
+def _fast_weights(
+    images: List[np.ndarray],
+    scale: float,
+    contrast: float,
+    saturation: float,
+    exposure: float,
+) -> List[np.ndarray]:
+    """
+    Mertens weights (contrast, saturation, well exposedness) of each image,
+    computed on downscaled images and normalized to sum to one on each pixel
+    """
+
+    weights = []
+    for image in images:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small = small.astype(np.float32) / 255
+        gray = small if small.ndim == 2 else cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        weight = np.ones(gray.shape, np.float32)
+        if contrast != 0:
+            weight *= np.abs(cv2.Laplacian(gray, cv2.CV_32F)) ** contrast
+        if saturation != 0 and small.ndim == 3:
+            weight *= small.std(axis=2) ** saturation
+        if exposure != 0:
+            well_exposed = np.exp(-((small - 0.5) ** 2) / (2 * 0.2**2))
+            if well_exposed.ndim == 3:
+                well_exposed = well_exposed.prod(axis=2)
+            weight *= well_exposed**exposure
+        weights.append(weight + 1e-12)
+
+    # smooth weights, so the single scale blend has no seams
+    total = np.zeros(weights[0].shape, np.float32)
+    for i in range(len(weights)):
+        weights[i] = cv2.GaussianBlur(weights[i], (0, 0), 2)
+        total += weights[i]
+    return [w / total for w in weights]
+
+
+def fuse_exposures(
+    images: List[np.ndarray],
+    method: str = "mertens",
+    contrast: float = 1.0,
+    saturation: float = 1.0,
+    exposure: float = 1.0,
+    weights_scale: float = 0.125,
+) -> np.ndarray:
+    """
+    Fuse the frames of an exposure bracket into one 8 bit image
+
+    Args:
+        images: frames of the bracket, all bgr or all mono8, with the same size
+        method: one of the fusion methods
+                mertens: multi scale exposure fusion (cv2.createMergeMertens)
+                fast: Mertens weights computed at weights_scale, blended at full resolution in a single scale
+        contrast, saturation, exposure: exponents of the Mertens weights
+        weights_scale: resolution of the weights of the fast method
+
+    Returns:
+        the fused image, with the channels of the input frames
+    """
+
+    if method not in fusion_methods:
+        raise ValueError(f"Invalid fusion method {method}, available methods: {fusion_methods}")
+
+    if method == "mertens":
+        merge = cv2.createMergeMertens(contrast, saturation, exposure)
+        fused = merge.process(images)
+        np.multiply(fused, 255, out=fused)
+        np.clip(fused, 0, 255, out=fused)
+        return fused.astype(np.uint8)
+
+    height, width = images[0].shape[:2]
+    weights = _fast_weights(images, weights_scale, contrast, saturation, exposure)
+    fused = np.zeros(images[0].shape, np.float32)
+    for image, weight in zip(images, weights):
+        weight = cv2.resize(weight, (width, height), interpolation=cv2.INTER_LINEAR)
+        if image.ndim == 3:
+            weight = weight[..., None]
+        fused += image * weight
+    return fused.astype(np.uint8)
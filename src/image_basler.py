@@ -1,10 +1,95 @@
 import cv2
-from collections import defaultdict
+import itertools
 import json
 import numpy as np
 from typing import Union, List, Dict, Tuple
 from PIL import Image, ImageDraw, ImageFont
 import os
+import io
+import threading
+
+# available output encodings: file extension, mimetype and the opencv parameter
+# controlled by the quality value (compression level 0-9 for png, quality 0-100 for jpeg and webp)
+encodings = {
+    "png": (".png", "image/png", cv2.IMWRITE_PNG_COMPRESSION),
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    "tiff": (".tiff", "image/tiff", None),
+    "npy": (".npy", "application/octet-stream", None),
+}
+
+# output pixel formats: native mono images, raw bayer images demosaiced only
+# when a color image is needed, or color images converted at grab time
+pixel_formats = ["bgr", "mono8", "bayer"]
+
+# opencv conversion codes of the bayer patterns, opencv names a pattern
+# after the second row, so the codes are swapped with respect to the GenICam names
+bayer_codes = {
+    "BayerRG8": (cv2.COLOR_BayerBG2BGR, cv2.COLOR_BayerBG2GRAY),
+    "BayerBG8": (cv2.COLOR_BayerRG2BGR, cv2.COLOR_BayerRG2GRAY),
+    "BayerGR8": (cv2.COLOR_BayerGB2BGR, cv2.COLOR_BayerGB2GRAY),
+    "BayerGB8": (cv2.COLOR_BayerGR2BGR, cv2.COLOR_BayerGR2GRAY),
+}
+
+# clockwise rotations
+rotation_codes = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def rotate_bayer_pattern(pattern: str, shape: Tuple[int, int], rotation: int) -> str:
+    """
+    Bayer pattern of a raw image rotated clockwise: the rotated mosaic is still
+    a bayer mosaic, its pattern depends on the rotation and on the parity of the image size
+    """
+    cells = {
+        "BayerRG8": ["RG", "GB"],
+        "BayerBG8": ["BG", "GR"],
+        "BayerGR8": ["GR", "BG"],
+        "BayerGB8": ["GB", "RG"],
+    }
+    cell = np.array([list(row) for row in cells[pattern]])
+    # pattern tile with the same parity of the image
+    tile = np.tile(cell, (2, 2))[: 2 + shape[0] % 2, : 2 + shape[1] % 2]
+    rotated = np.rot90(tile, k=-(rotation // 90))
+    return "Bayer" + rotated[0, 0] + rotated[0, 1] + "8"
+
+
+def encode_image(image: np.ndarray, encoding: str = "png", quality: int = None) -> bytes:
+    """
+    Encode an image in one of the available encodings
+
+    Args:
+        image: the image to encode
+        encoding: a key of the encodings dictionary
+        quality: compression level for png, quality for jpeg and webp,
+                 if None the opencv default is used
+
+    Returns:
+        the encoded bytes
+    """
+
+    if encoding not in encodings.keys():
+        raise ValueError(
+            f"Invalid encoding {encoding}, available encodings: {list(encodings.keys())}"
+        )
+    ext, _, param = encodings[encoding]
+
+    # raw numpy array
+    if encoding == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, image)
+        return buffer.getvalue()
+
+    params = []
+    if param is not None and quality is not None:
+        params = [param, int(quality)]
+    ok, buffer = cv2.imencode(ext, image, params)
+    if not ok:
+        raise ValueError("Image encoding failed")
+    return buffer.tobytes()
 
 
 class ImageBasler:
@@ -13,9 +98,150 @@ class ImageBasler:
         os.path.relpath(os.path.dirname(__file__)), "..", "data", "results"
     )
 
+    # sequence number of the saved images, the timestamps have a resolution of one second
+    _image_numbers = itertools.count()
+
+    # order of the keys stored in the results
+    key_order = [
+        "cam_iden",
+        "timestamp",
+        "exposure_time",
+        "autoexposure",
+        "autoexposure_iterations",
+        "autoexposure_time_ms",
+        "autoexposure_brightness",
+        "autoexposure_converged",
+        "autoexposure_status",
+        "image_path",
+        "success",
+        "rotation_angle",
+        "pixel_format",
+        "bayer_pattern",
+        "encoding",
+        "encoding_quality",
+        "tick_timestamp",
+        "trigger_offset_ms",
+        "sync_skew_ms",
+        "sync_tick_skew_us",
+        "transfer_planned_ms",
+        "transfer_ms",
+        "burst_mode",
+        "burst_index",
+        "burst_interval_ms",
+        "hdr_exposures",
+        "hdr_stops",
+        "hdr_fusion",
+        "hdr_fusion_ms",
+        "timeout_stage",
+        "error_msg",
+    ]
+
     def __init__(self, image_info: dict, image: np.array) -> None:
-        self.image = image
+        """
+        Args:
+            image_info: the image info, "pixel_format" and "bayer_pattern" describe the image
+            image: the image in its native pixel format, a raw mosaic for bayer images
+        """
+        self.raw = image
         self.image_info = image_info
+        # rotation kept as metadata, applied to the outputs (views, encoded images, thumbnails)
+        self._rotation = 0
+        self._bayer_pattern = image_info.get("bayer_pattern", None)
+        self._color = None
+        self._encoded = None
+        self._encode_lock = threading.Lock()
+        # qrcodes decoded by the post-capture stage
+        self.qrcodes = None
+
+    def _rotated(self, image: np.ndarray) -> np.ndarray:
+        """
+        Rotated view of an image, without copies
+        """
+        if image is None or self._rotation == 0:
+            return image
+        return np.rot90(image, k=-(self._rotation // 90))
+
+    def _unrotated(self) -> np.ndarray:
+        """
+        The image ready to be displayed before the rotation, bayer images are demosaiced on first access
+        """
+        if self.image_info.get("pixel_format", "bgr") != "bayer" or self.raw is None:
+            return self.raw
+        if self._color is None:
+            self._color = cv2.cvtColor(self.raw, bayer_codes[self._bayer_pattern][0])
+        return self._color
+
+    @property
+    def image(self) -> np.ndarray:
+        """
+        The image ready to be displayed, as a rotated view (not contiguous if rotated by 90 or 270)
+        """
+        return self._rotated(self._unrotated())
+
+    @image.setter
+    def image(self, image: np.ndarray) -> None:
+        self.raw = image
+        self._rotation = 0
+        self._bayer_pattern = self.image_info.get("bayer_pattern", None)
+        self._color = None
+
+    def copy(self, image_info: dict) -> "ImageBasler":
+        """
+        Copy with a different image info, sharing the image buffers
+        """
+        image_basler = ImageBasler(image_info, self.raw)
+        image_basler._rotation = self._rotation
+        image_basler._bayer_pattern = self._bayer_pattern
+        image_basler._color = self._color
+        return image_basler
+
+    def release(self) -> None:
+        """
+        Drop the image buffers, a pooled buffer goes back to its pool when no copy
+        of the image nor any other view of it is left. The image can not be used afterwards.
+        """
+        self.raw = None
+        self._color = None
+        self._encoded = None
+
+    def gray(self) -> np.ndarray:
+        """
+        Single channel image, for consumers that do not need color (e.g. qrcodes),
+        bayer images are converted without demosaicing
+        """
+        pixel_format = self.image_info.get("pixel_format", "bgr")
+        if self.raw is None or (self.raw.ndim == 2 and pixel_format != "bayer"):
+            return self._rotated(self.raw)
+        if pixel_format == "bayer" and self._color is None:
+            gray = cv2.cvtColor(self.raw, bayer_codes[self._bayer_pattern][1])
+        else:
+            gray = cv2.cvtColor(self._unrotated(), cv2.COLOR_BGR2GRAY)
+        return self._rotated(gray)
+
+    def thumbnail(self, scale: float) -> np.ndarray:
+        """
+        Resized image, the rotation is applied after resizing
+        """
+        image = self._unrotated()
+        if scale != 1:
+            image = cv2.resize(
+                image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+        if self._rotation == 0:
+            return image
+        return cv2.rotate(image, rotation_codes[self._rotation])
+
+    def nbytes(self) -> int:
+        """
+        Bytes held in memory by the image, its demosaiced and encoded versions
+        """
+        size = 0
+        for image in [self.raw, self._color]:
+            if image is not None:
+                size += image.nbytes
+        if self._encoded is not None:
+            size += len(self._encoded)
+        return size
 
     @staticmethod
     def init_error(image_info: dict, error_msg: str):
@@ -57,27 +283,28 @@ class ImageBasler:
     def error_msg(self) -> str:
         return self.image_info["error_msg"]
 
-    def image(self) -> np.ndarray:
-        return self.image_info["image"]
-
     def rotate_image(self, rotation_angle) -> None:
+        """
+        Rotate the image clockwise, the rotation is only recorded:
+        the pixels are moved when an output is produced (encode, thumbnail),
+        while the image attribute is a rotated view
+        """
         if rotation_angle == 0:
             self.image_info["rotation_angle"] = str(rotation_angle)
             return self
 
-        rotations = {
-            90: cv2.ROTATE_90_CLOCKWISE,
-            180: cv2.ROTATE_180,
-            270: cv2.ROTATE_90_COUNTERCLOCKWISE,
-        }
-
-        if rotation_angle not in rotations.keys():
+        if rotation_angle not in rotation_codes.keys():
             return self.init_error(
                 self.image_info,
                 f"Invalid rotation angle, available angles: 0, 90, 180, 270",
             )
         else:
-            self.image = cv2.rotate(self.image, rotations[rotation_angle])
+            self._rotation = (self._rotation + rotation_angle) % 360
+            # pattern of the rotated bayer image, as it is saved in npy files
+            if self.image_info.get("pixel_format", "bgr") == "bayer":
+                self.image_info["bayer_pattern"] = rotate_bayer_pattern(
+                    self._bayer_pattern, self.raw.shape, self._rotation
+                )
             self.image_info["rotation_angle"] = str(rotation_angle) + " (clockwise)"
             return self
 
@@ -87,81 +314,102 @@ class ImageBasler:
         returns an IMageBasler object from a dictionary inside a json file
         """
 
-        image = cv2.imread(data["image_path"])
+        # npy files keep the native pixel format, other encodings are decoded images
+        if data["image_path"].endswith(encodings["npy"][0]):
+            image = np.load(data["image_path"])
+        else:
+            image = cv2.imread(data["image_path"], cv2.IMREAD_UNCHANGED)
+            if image is not None:
+                data["pixel_format"] = "mono8" if image.ndim == 2 else "bgr"
         image_basler = ImageBasler(image_info=data, image=image)
         return image_basler
 
-    def save(self, json_path=None, max_result_num=10) -> True:
+    def set_encoding(self, encoding: str = "png", quality: int = None) -> None:
+        """
+        Set the encoding used to save and send the image
+        """
+        if encoding not in encodings.keys():
+            raise ValueError(
+                f"Invalid encoding {encoding}, available encodings: {list(encodings.keys())}"
+            )
+        with self._encode_lock:
+            self.image_info["encoding"] = encoding
+            self.image_info["encoding_quality"] = quality
+            self._encoded = None
 
-        key_order = [
-            "cam_iden",
-            "timestamp",
-            "exposure_time",
-            "autoexposure",
-            "image_path",
-            "success",
-            "rotation_angle",
-            "error_msg",
-        ]
+    def mimetype(self) -> str:
+        return encodings[self.image_info.get("encoding", "png")][1]
 
-        if self.image_info["success"]:
+    def encode(self) -> bytes:
+        """
+        Encode the image in the output format, the result is cached so that
+        the image is encoded only once by the writer and the clients.
+        npy files keep the native pixel format, so bayer images are not demosaiced.
+        The rotation is applied here, in the only copy made before encoding.
+        """
+        with self._encode_lock:
+            if self._encoded is None:
+                encoding = self.image_info.get("encoding", "png")
+                if encoding == "npy":
+                    image = self._rotated(self.raw)
+                else:
+                    image = self._unrotated()
+                    if self._rotation != 0:
+                        image = cv2.rotate(image, rotation_codes[self._rotation])
+                self._encoded = encode_image(
+                    image, encoding, self.image_info.get("encoding_quality", None)
+                )
+            return self._encoded
+
+    def set_image_path(self) -> None:
+        """
+        Assign the path where the image will be saved, and sort the image info.
+        The path is unique, it identifies the image in the results (e.g. its qrcodes),
+        and it is assigned only once.
+        """
+
+        if self.image_info["success"] and self.image_info.get("image_path", None) is None:
 
             # image_name = f"{self.image_info['timestamp'].replace(' ','_')};cam_{self.image_info['cam_iden']}"
             image_name = f"{self.image_info['cam_iden']}_{self.image_info['timestamp'].replace(' ','_').replace(':','-')}"
+            # the images of a burst share the timestamp of the capture
+            if "burst_index" in self.image_info.keys():
+                image_name += f"_{self.image_info['burst_index']}"
+            # captures in the same second and images of the same capture share the timestamp
+            image_name += f"_{next(self._image_numbers)}"
             images_dir = os.path.join(self.results_dir, "images")
 
-            os.makedirs(self.results_dir, exist_ok=True)
-            os.makedirs(images_dir, exist_ok=True)
-
             # add image path to image info
-            image_path = os.path.join(f"{images_dir}", f"{image_name}.png")
+            ext = encodings[self.image_info.get("encoding", "png")][0]
+            image_path = os.path.join(f"{images_dir}", f"{image_name}{ext}")
             self.image_info["image_path"] = image_path
             self.image_info["error_msg"] = None
-            self.image_info = {k: self.image_info[k] for k in key_order}
 
-            # save image
-            cv2.imwrite(image_path, self.image)
+        self.image_info = {
+            k: self.image_info[k] for k in self.key_order if k in self.image_info.keys()
+        }
+        # self.image_info["cam_iden"] = None
+        # # self.image_info["exposure_time"] = None
+        # # self.image_info["autoexposure"] = None
+        # self.image_info["image_path"] = None
 
-        else:
-            self.image_info = {
-                k: self.image_info[k] for k in key_order if k in self.image_info.keys()
-            }
-            # self.image_info["cam_iden"] = None
-            # # self.image_info["exposure_time"] = None
-            # # self.image_info["autoexposure"] = None
-            # self.image_info["image_path"] = None
-
-        if json_path is not None:
-
-            # create json if not exist
-            os.makedirs(self.results_dir, exist_ok=True)
-            json_path = os.path.join(f"{self.results_dir}","results.json")
-
-
-            try:
-                with open(json_path, "r") as f:
-                    data = json.load(f)
-                    if self.image_info["cam_iden"] not in data.keys():
-                        data[self.image_info["cam_iden"]] = []
-            except:
-                with open(json_path, "w") as f:
-                    f.write("")
-                data = defaultdict(list)
-
-            data[self.image_info["cam_iden"]].append(self.image_info)
-
-            # remove old
-            for d in data[self.image_info["cam_iden"]][:-max_result_num]:
-                try:
-                    os.remove(d["image_path"])
-                except:
-                    {}
-
-            if len(data[self.image_info["cam_iden"]]) > max_result_num:
-                data[self.image_info["cam_iden"]] = data[self.image_info["cam_iden"]][
-                    -max_result_num:
-                ]
-
-            # Write data back to file
-            with open(json_path, "w") as f:
-                json.dump(dict(data), f, indent=4)
+    def write(self) -> None:
+        """
+        Write the image in the path assigned by set_image_path()
+        """
+
+        if self.image_info["success"]:
+            image_path = self.image_info["image_path"]
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            with open(image_path, "wb") as f:
+                f.write(self.encode())
+
+    def save(self, results_store=None) -> None:
+        """
+        Save the image and add it to the results index, in the calling thread
+        """
+
+        self.set_image_path()
+        self.write()
+        if results_store is not None:
+            results_store.add(self.image_info)
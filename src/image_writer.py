@@ -0,0 +1,125 @@
+import atexit
+import logging
+import queue
+import threading
+import zlib
+from typing import List
+from image_basler import ImageBasler
+from results_store import ResultsStore
+
+
+class ImageWriter:
+    """
+    Background pipeline that encodes and writes ImageBasler objects to the
+    results directory, and adds them to the results store.
+
+    Images are routed to a worker by camera identifier, so the images of a
+    camera are always written in capture order, while different cameras are
+    written concurrently.
+
+    Back-pressure: each worker has a bounded queue, submit() waits up to
+    put_timeout seconds for a free slot, then writes the image in the calling
+    thread. Images are never dropped.
+
+    Shutdown: close() (also registered at exit) waits for all the pending
+    images to be written before stopping the workers.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 2,
+        queue_size: int = 4,
+        put_timeout: float = 5,
+        log: logging.Logger = None,
+    ) -> None:
+        self._put_timeout = put_timeout
+        self._log = log if log is not None else logging.getLogger(__name__)
+        self._queues: List[queue.Queue] = []
+        self._workers: List[threading.Thread] = []
+        self._closed = False
+
+        for i in range(max(1, num_workers)):
+            q = queue.Queue(maxsize=queue_size)
+            worker = threading.Thread(
+                target=self._work, args=(q,), name=f"image_writer_{i}", daemon=True
+            )
+            self._queues.append(q)
+            self._workers.append(worker)
+            worker.start()
+
+        atexit.register(self.close)
+
+    def _work(self, q: queue.Queue) -> None:
+        """
+        Worker loop, a None item stops the worker
+        """
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            finally:
+                q.task_done()
+
+    def _write(self, image_basler: ImageBasler, results_store: ResultsStore) -> None:
+        try:
+            image_basler.write()
+            if results_store is not None:
+                results_store.add(image_basler.image_info)
+        except Exception as e:
+            self._log.error(
+                f"Image of camera {image_basler.image_info.get('cam_iden')} not saved: {e}"
+            )
+
+    def submit(
+        self, image_basler: ImageBasler, results_store: ResultsStore = None
+    ) -> None:
+        """
+        Queue an image to be saved, the image path is assigned immediately
+        so it is already available in the image info when this method returns
+        """
+
+        image_basler.set_image_path()
+        item = (image_basler, results_store)
+
+        if self._closed:
+            self._write(*item)
+            return
+
+        cam_iden = str(image_basler.image_info.get("cam_iden"))
+        q = self._queues[zlib.crc32(cam_iden.encode()) % len(self._queues)]
+        try:
+            q.put(item, timeout=self._put_timeout)
+        except queue.Full:
+            self._log.warning(
+                f"Image writer queue full, writing image of camera {cam_iden} synchronously"
+            )
+            # keep the order of the camera images
+            q.join()
+            self._write(*item)
+
+    def pending(self) -> int:
+        """
+        Number of images waiting to be written
+        """
+        return sum([q.unfinished_tasks for q in self._queues])
+
+    def flush(self) -> None:
+        """
+        Wait until all the submitted images have been written
+        """
+        for q in self._queues:
+            q.join()
+
+    def close(self) -> None:
+        """
+        Write all the pending images and stop the workers
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for q in self._queues:
+            q.put(None)
+        for worker in self._workers:
+            worker.join()
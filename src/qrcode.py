@@ -1,33 +1,213 @@
 import cv2
 import os
 import json
+import threading
 import numpy as np
 from pathlib import Path
+from typing import Union, List, Tuple
 
 # from pyzbar.pyzbar import decode
-import zxing
 from omegaconf import OmegaConf
 
+# in-process decoder, all the codes of an image are found in one pass
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+# legacy decoder, it starts a java process for each call
+try:
+    import zxing
+except ImportError:
+    zxing = None
+
 
 class QRCodeDetector:
+    """
+    Decoding of the qrcodes in an image.
+
+    The engine is set in the config file (qrcode.engine):
+    - zxingcpp: in-process ZXing decoder working on the image in memory
+    - cv2: opencv decoder, used if zxingcpp is not installed
+    - zxing: legacy ZXing java decoder, not thread safe (it writes a temporary file)
+    zxingcpp and cv2 can be called concurrently.
+    """
+
+    engines = ["zxingcpp", "cv2", "zxing"]
 
     def __init__(self, config_path: str) -> None:
         self._cfg = OmegaConf.load(config_path)  # load config file
+        self.engine = self._cfg.qrcode.engine
+        if self.engine == "zxingcpp" and zxingcpp is None:
+            self.engine = "cv2"
+        # opencv detectors can not be shared between threads
+        self._cv2_detectors = threading.local()
 
     # combine methods and returns the union of the lists
-    def detect_qrcodes(self, image_path: str):
+    def detect_qrcodes(
+        self,
+        image: Union[str, np.ndarray],
+        engine: str = None,
+        rois: List[List[float]] = None,
+        pyramid: bool = None,
+    ):
+        """
+        Args:
+            image: image path or image in memory
+            engine: one of the engines, if None the configured engine is used
+            rois: regions of interest [x_min, y_min, x_max, y_max] as fractions
+                  of the image size, if None the whole image is searched
+            pyramid: coarse to fine search, if None the config value is used
+
+        Returns:
+            the list of the decoded qrcodes
+        """
+        if engine is None:
+            engine = self.engine
+        if engine not in self.engines:
+            raise ValueError(f"Invalid qrcode engine {engine}, available engines: {self.engines}")
+        if pyramid is None:
+            pyramid = self._cfg.qrcode.pyramid.enabled
+
+        # the legacy engine decodes files, the whole image is searched
+        if engine == "zxing":
+            return list(set(self._detect_qrcodes_zxing(image)))
+
+        if isinstance(image, str):
+            image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
         res = []
-        # res += self._detect_qrcodes_cv2(image_path)
+        for patch in self._roi_patches(image, rois):
+            patch = self._gray(patch)
+            if pyramid:
+                res += self._pyramid_search(patch, engine)
+            else:
+                res += self._decode_patch(patch, engine)
         # res += self._detect_qrcodes_pyzbar(image_path)
-        res += self._detect_qrcodes_zxing(image_path)
         return list(set(res))
 
-    def _detect_qrcodes_zxing(self, image_path: str, res_old=[]):
+    @staticmethod
+    def _roi_patches(image: np.ndarray, rois: List[List[float]] = None) -> List[np.ndarray]:
+        """
+        Views of the regions of interest of an image
+        """
+        if not rois:
+            return [image]
+        h, w = image.shape[:2]
+        return [
+            image[int(y_min * h) : int(y_max * h), int(x_min * w) : int(x_max * w)]
+            for x_min, y_min, x_max, y_max in rois
+        ]
+
+    def _decode_patch(self, patch: np.ndarray, engine: str) -> List[str]:
+        if engine == "zxingcpp":
+            return self._detect_qrcodes_zxingcpp(patch)
+        return self._detect_qrcodes_cv2(patch)
+
+    def _locate(self, image: np.ndarray, engine: str) -> List[Tuple[float, float, float, float]]:
+        """
+        Bounding boxes of the qrcodes found in an image, decoded or not
+        """
+        if engine == "zxingcpp":
+            results = zxingcpp.read_barcodes(
+                image, formats=zxingcpp.BarcodeFormat.QRCode, return_errors=True
+            )
+            corners = []
+            for r in results:
+                p = r.position
+                corners.append(
+                    [
+                        (q.x, q.y)
+                        for q in [p.top_left, p.top_right, p.bottom_right, p.bottom_left]
+                    ]
+                )
+        else:
+            ok, points = self._cv2_detector().detectMulti(image)
+            corners = points if ok and points is not None else []
+
+        return [
+            (
+                min([c[0] for c in pts]),
+                min([c[1] for c in pts]),
+                max([c[0] for c in pts]),
+                max([c[1] for c in pts]),
+            )
+            for pts in corners
+        ]
+
+    def _pyramid_search(self, patch: np.ndarray, engine: str) -> List[str]:
+        """
+        Coarse to fine search: the qrcodes are located on a downscaled image,
+        then they are decoded on full resolution crops around them.
+        With the fallback, the whole patch is decoded at full resolution if nothing
+        was decoded or a located qrcode could not be decoded from its crop.
+        Qrcodes too small to be located on the downscaled image are still missed
+        when all the located ones are decoded.
+        """
+        cfg = self._cfg.qrcode.pyramid
+        small = cv2.resize(
+            patch, None, fx=cfg.scale, fy=cfg.scale, interpolation=cv2.INTER_AREA
+        )
+        h, w = patch.shape[:2]
+
+        res = []
+        # located qrcodes not decoded from their crop
+        missed = 0
+        for x_min, y_min, x_max, y_max in self._locate(small, engine):
+            # crop at full resolution, enlarged by the margin
+            margin = cfg.margin * max(x_max - x_min, y_max - y_min)
+            x_min = max(0, int((x_min - margin) / cfg.scale))
+            y_min = max(0, int((y_min - margin) / cfg.scale))
+            x_max = min(w, int((x_max + margin) / cfg.scale) + 1)
+            y_max = min(h, int((y_max + margin) / cfg.scale) + 1)
+            crop = np.ascontiguousarray(patch[y_min:y_max, x_min:x_max])
+            codes = self._decode_patch(crop, engine)
+            if len(codes) == 0:
+                missed += 1
+            res += codes
+
+        # codes too small to be located on the downscaled image, or not decoded from their crop
+        if (len(res) == 0 or missed > 0) and cfg.fallback:
+            res += self._decode_patch(patch, engine)
+        return res
+
+    @staticmethod
+    def _gray(image: Union[str, np.ndarray]) -> np.ndarray:
+        """
+        Contiguous single channel image, from a path or an image in memory
+        """
+        if isinstance(image, str):
+            return cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        if image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return np.ascontiguousarray(image)
+
+    def _cv2_detector(self) -> cv2.QRCodeDetector:
+        """
+        QRCode detector of the calling thread
+        """
+        if not hasattr(self._cv2_detectors, "detector"):
+            self._cv2_detectors.detector = cv2.QRCodeDetector()
+        return self._cv2_detectors.detector
 
-        img = cv2.imread(image_path)
+    def _detect_qrcodes_zxingcpp(self, image: Union[str, np.ndarray]) -> List[str]:
+        results = zxingcpp.read_barcodes(
+            self._gray(image), formats=zxingcpp.BarcodeFormat.QRCode
+        )
+        return [r.text for r in results if r.text]
+
+    def _detect_qrcodes_zxing(self, image: Union[str, np.ndarray], res_old=[]):
 
         tmp_path = str(Path(os.getcwd()) / "qrcode_tmp.png")
 
+        # image path or image in memory
+        if isinstance(image, str):
+            image_path = image
+            img = cv2.imread(image_path)
+        else:
+            image_path = tmp_path
+            img = image.copy()
+            cv2.imwrite(tmp_path, img)
+
         # Initialize the ZXing Barcode Reader
         reader = zxing.BarCodeReader()
         # Decode the QR codes in the image
@@ -39,7 +219,7 @@ class QRCodeDetector:
             y_min = int(min([p[1] for p in res.points]))
             y_max = int(max([p[1] for p in res.points]))
 
-            img[y_min:y_max, x_min:x_max, :] = 0
+            img[y_min:y_max, x_min:x_max, ...] = 0
             # save image
             cv2.imwrite(tmp_path, img)
             res_new = self._detect_qrcodes_zxing(tmp_path, res_old + [res.parsed])
@@ -49,10 +229,9 @@ class QRCodeDetector:
                 os.remove(tmp_path)
             return res_old
 
-    def _detect_qrcodes_cv2(self, image_path: str):
-        image = cv2.imread(image_path)
-        # Initialize QRCode detector
-        detector = cv2.QRCodeDetector()
+    def _detect_qrcodes_cv2(self, image: Union[str, np.ndarray]) -> List[str]:
+        image = self._gray(image)
+        detector = self._cv2_detector()
 
         # Detect and decode the QR code
         retval, decoded_info, points, straight_qrcode = detector.detectAndDecodeMulti(
@@ -60,7 +239,7 @@ class QRCodeDetector:
         )
 
         # If points are detected, it means QR codes are found
-        if points is not None:
+        if retval and points is not None:
             # Only return detected data (QR code content) that is non-empty
             return [d for d in decoded_info if d]
         else:
@@ -82,10 +261,10 @@ class QRCodeDetector:
         return decoded_info
 
     #
-    def decode(self, image_path):
+    def decode(self, image: Union[str, np.ndarray], rois: List[List[float]] = None):
 
         # add qrcodes
-        qr_list = self.detect_qrcodes(image_path)
+        qr_list = self.detect_qrcodes(image, rois=rois)
         qr_data = {"qrcodes": qr_list}
 
         return qr_data
@@ -0,0 +1,118 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+from image_basler import ImageBasler
+from results_store import ResultsStore
+
+
+class QRCodeStage:
+    """
+    Post-capture stage decoding the qrcodes of the captured images in a pool
+    of worker threads, right after the capture.
+
+    The qrcodes are stored in the results store, keyed by image path (unique
+    for each image), so the qrcodes of an image are decoded only once. While an image is being
+    decoded its future is kept, so a lookup can wait for the decode instead
+    of decoding the image again.
+    """
+
+    def __init__(
+        self,
+        decode: Callable[[ImageBasler], List[str]],
+        results_store: ResultsStore,
+        num_workers: int = 2,
+        log: logging.Logger = None,
+    ) -> None:
+        """
+        Args:
+            decode: function returning the qrcodes of an image
+            results_store: store of the decoded qrcodes
+            num_workers: number of decoding threads
+        """
+        self._decode = decode
+        self._results = results_store
+        self._log = log if log is not None else logging.getLogger(__name__)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, num_workers), thread_name_prefix="qrcode"
+        )
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+        atexit.register(self.close)
+
+    def _work(self, image_basler: ImageBasler, image_path: str) -> List[str]:
+        try:
+            qrcodes = self._decode(image_basler)
+            image_basler.qrcodes = qrcodes
+            self._results.set_qrcodes(
+                image_path, image_basler.image_info["cam_iden"], qrcodes
+            )
+            return qrcodes
+        except Exception as e:
+            self._log.error(f"Qrcodes of image {image_path} not decoded: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(image_path, None)
+
+    def submit(self, image_basler: ImageBasler) -> Future:
+        """
+        Queue an image to be decoded, the image path must be already assigned
+
+        Returns:
+            the future of the decoded qrcodes, None if the image can not be decoded
+        """
+        image_path = image_basler.image_info.get("image_path", None)
+        if self._closed or not image_basler.success() or image_path is None:
+            return None
+        with self._lock:
+            future = self._executor.submit(self._work, image_basler, image_path)
+            self._pending[image_path] = future
+        return future
+
+    def get(self, image_path: str) -> List[str]:
+        """
+        Qrcodes of an image, from the store, waiting for the decode if it is in progress
+
+        Returns:
+            the qrcodes, None if the image has not been decoded
+        """
+        with self._lock:
+            future = self._pending.get(image_path, None)
+        if future is not None:
+            return future.result()
+        return self._results.get_qrcodes(image_path)
+
+    def is_pending(self, image_path: str) -> bool:
+        """
+        True if the image is being decoded
+        """
+        with self._lock:
+            return image_path in self._pending.keys()
+
+    def pending(self) -> int:
+        """
+        Number of images waiting to be decoded
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> None:
+        """
+        Wait until all the submitted images have been decoded
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        wait(futures)
+
+    def close(self) -> None:
+        """
+        Decode all the pending images and stop the workers
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+
+class ResultsStore:
+    """
+    Index of the captured images, stored in a SQLite database.
+
+    Every append and its retention (removal of the oldest images of the
+    camera beyond max_result_num) run in a single transaction, so concurrent
+    captures can not corrupt the index. The last image info of each camera
+    is also kept in memory, so the lookup of the last image does not touch
+    the database. The decoded qrcodes are stored keyed by image path, which is
+    unique for each image (see ImageBasler.set_image_path), and removed with
+    their image.
+    """
+
+    def __init__(
+        self, db_path: str, max_result_num: int = 10, log: logging.Logger = None
+    ) -> None:
+        self._db_path = db_path
+        self._max_result_num = max_result_num
+        self._log = log if log is not None else logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "cam_iden TEXT NOT NULL, "
+            "image_path TEXT, "
+            "info TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_cam ON results (cam_iden, id)"
+        )
+        # decoded qrcodes of the images
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS qrcodes ("
+            "image_path TEXT PRIMARY KEY, "
+            "cam_iden TEXT NOT NULL, "
+            "codes TEXT NOT NULL)"
+        )
+
+        # last image info of each camera
+        self._last: Dict[str, dict] = {}
+        rows = self._conn.execute(
+            "SELECT info FROM results WHERE id IN "
+            "(SELECT MAX(id) FROM results GROUP BY cam_iden)"
+        )
+        for (info,) in rows:
+            info = json.loads(info)
+            self._last[info["cam_iden"]] = info
+
+    def _insert(self, image_info: dict) -> List[str]:
+        """
+        Insert an image info and apply the retention, inside an open transaction
+
+        Returns:
+            the paths of the images removed from the index
+        """
+
+        cam_iden = image_info["cam_iden"]
+        self._conn.execute(
+            "INSERT INTO results (cam_iden, image_path, info) VALUES (?, ?, ?)",
+            (cam_iden, image_info.get("image_path"), json.dumps(image_info)),
+        )
+
+        # remove old
+        old = self._conn.execute(
+            "SELECT id, image_path FROM results WHERE cam_iden = ? "
+            "ORDER BY id DESC LIMIT -1 OFFSET ?",
+            (cam_iden, self._max_result_num),
+        ).fetchall()
+        self._conn.executemany(
+            "DELETE FROM results WHERE id = ?", [(id_,) for id_, _ in old]
+        )
+        self._conn.executemany(
+            "DELETE FROM qrcodes WHERE image_path = ?",
+            [(path,) for _, path in old if path is not None],
+        )
+        return [path for _, path in old if path is not None]
+
+    def _remove_files(self, paths: List[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except:
+                {}
+
+    def add(self, image_info: dict) -> None:
+        """
+        Append an image info to the index, removing the oldest images of the camera
+        """
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._insert(image_info)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._last[image_info["cam_iden"]] = image_info
+        self._remove_files(removed)
+
+    def last(self, cam_iden: str) -> dict:
+        """
+        Info of the last image captured by a camera, None if there are no images
+        """
+        return self._last.get(cam_iden, None)
+
+    def set_qrcodes(self, image_path: str, cam_iden: str, qrcodes: List[str]) -> None:
+        """
+        Store the decoded qrcodes of an image
+        """
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO qrcodes (image_path, cam_iden, codes) VALUES (?, ?, ?)",
+                (image_path, cam_iden, json.dumps(qrcodes)),
+            )
+
+    def get_qrcodes(self, image_path: str) -> List[str]:
+        """
+        Decoded qrcodes of an image, None if the image has not been decoded
+        """
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT codes FROM qrcodes WHERE image_path = ?", (image_path,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def all(self) -> Dict[str, List[dict]]:
+        """
+        Info of all the stored images, grouped by camera and sorted by capture
+        """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT cam_iden, info FROM results ORDER BY id"
+            ).fetchall()
+        data = {}
+        for cam_iden, info in rows:
+            data.setdefault(cam_iden, []).append(json.loads(info))
+        return data
+
+    def rename(self, old_iden: str, new_iden: str) -> None:
+        """
+        Move the images of a camera to a new identifier
+        """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, info FROM results WHERE cam_iden = ?", (old_iden,)
+            ).fetchall()
+            updates = []
+            for id_, info in rows:
+                info = json.loads(info)
+                info["cam_iden"] = new_iden
+                updates.append((new_iden, json.dumps(info), id_))
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "UPDATE results SET cam_iden = ?, info = ? WHERE id = ?", updates
+            )
+            self._conn.execute(
+                "UPDATE qrcodes SET cam_iden = ? WHERE cam_iden = ?", (new_iden, old_iden)
+            )
+            self._conn.execute("COMMIT")
+            if old_iden in self._last.keys():
+                self._last[new_iden] = self._last.pop(old_iden)
+                self._last[new_iden]["cam_iden"] = new_iden
+
+    def clear(self) -> None:
+        """
+        Remove all the images and their infos
+        """
+
+        with self._lock:
+            paths = [
+                path
+                for (path,) in self._conn.execute(
+                    "SELECT image_path FROM results WHERE image_path IS NOT NULL"
+                )
+            ]
+            self._conn.execute("DELETE FROM results")
+            self._conn.execute("DELETE FROM qrcodes")
+            self._last = {}
+        self._remove_files(paths)
+
+    def migrate_json(self, json_path: str) -> bool:
+        """
+        Import the results of the old results.json file, if the index is empty.
+        The json file is renamed, so that it is imported only once.
+
+        Returns:
+            True if results have been imported
+        """
+
+        if not os.path.exists(json_path):
+            return False
+
+        with self._lock:
+            if self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] > 0:
+                return False
+            try:
+                with open(json_path, "r") as f:
+                    data = json.load(f)
+            except:
+                data = {}
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            removed = []
+            for cam_iden, infos in data.items():
+                for info in infos:
+                    info["cam_iden"] = cam_iden
+                    removed += self._insert(info)
+                    self._last[cam_iden] = info
+            self._conn.execute("COMMIT")
+
+        os.replace(json_path, json_path + ".migrated")
+        self._remove_files(removed)
+        self._log.info(f"Results migrated from {json_path} to {self._db_path}")
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
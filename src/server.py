@@ -1,7 +1,11 @@
-from flask import Flask, send_file, jsonify
-from flask_restful import Api, Resource, reqparse
+from flask import Flask, Response, send_file, jsonify, stream_with_context
+from flask_restful import Api, Resource, reqparse, inputs
 from basler_handler import BaslerHandler
 from pathlib import Path
+from io import BytesIO
+import atexit
+import itertools
+import json
 import os
 from omegaconf import OmegaConf
 
@@ -12,6 +16,27 @@ data_path = script_path / ".." / "data" / "results"
 images_path = data_path / "images"
 config_path = script_path / ".." / "config.yaml"
 bh = BaslerHandler(os.path.realpath(str(config_path)))
+atexit.register(bh.close)  # write pending images on shutdown
+
+
+# optional arguments of the capture endpoint
+image_parser = reqparse.RequestParser()
+image_parser.add_argument("encoding", type=str, location="args")
+image_parser.add_argument("quality", type=int, location="args")
+image_parser.add_argument("qrcodes", type=inputs.boolean, location="args")
+image_parser.add_argument("wait_qrcodes", type=inputs.boolean, location="args", default=False)
+image_parser.add_argument("budget_ms", type=float, location="args")
+
+# optional arguments of the qrcodes endpoint
+qrcode_parser = reqparse.RequestParser()
+qrcode_parser.add_argument("wait", type=inputs.boolean, location="args", default=True)
+
+
+# optional arguments of the live stream endpoint
+stream_parser = reqparse.RequestParser()
+stream_parser.add_argument("scale", type=float, location="args")
+stream_parser.add_argument("fps", type=float, location="args")
+stream_parser.add_argument("quality", type=int, location="args")
 
 
 def check_cam_iden(cam_iden):
@@ -46,33 +71,97 @@ class Image(Resource):
         if not check_cam_iden(cam_iden):
             return jsonify({"error": f"Camera {cam_iden} not configured"})
 
+        args = image_parser.parse_args()
         devices_info = bh._devices_info_configured
-        bh.capture(
+        results = bh.capture(
             cam_idens=cam_iden,
             exposure_time=devices_info[cam_iden]["exposure_time"],
             gamma=devices_info[cam_iden]["gamma"],
+            encoding=args["encoding"],
+            encoding_quality=args["quality"],
+            qrcodes=args["qrcodes"],
+            wait_qrcodes=args["wait_qrcodes"],
+            budget_ms=args["budget_ms"],
         )
+        if isinstance(results, str):
+            return jsonify({"error": results})
         # bh._log.info("Reading QR codes")
         # bh.qrcodes.postprocess()
-        images_info = bh.get_last_img_info(cam_iden)
+        image_basler = results[-1]
 
-        # if image_path is not None (no error):
-        if images_info["success"]:
-            image_path = images_info["image_path"]
+        # send the image from memory, it's written to disk in background
+        if image_basler.success():
             request_img = send_file(
-                image_path,
-                mimetype="image/png",
+                BytesIO(image_basler.encode()),
+                mimetype=image_basler.mimetype(),
             )
+            if args["wait_qrcodes"]:
+                request_img.headers["X-QRCodes"] = json.dumps(image_basler.qrcodes)
             return request_img
         else:
-            return jsonify(images_info)
+            return jsonify(image_basler.image_info)
+
+
+class Snapshot(Resource):
+
+    # return the last frame of the background acquisition, with its age
+    def get(self, cam_iden):
+        if not check_cam_iden(cam_iden):
+            return jsonify({"error": f"Camera {cam_iden} not configured"})
+        args = image_parser.parse_args()
+        image_basler = bh.snapshot(cam_iden)
+        if not image_basler.success():
+            return jsonify(image_basler.image_info)
+        image_basler.set_encoding(
+            *bh._get_encoding(cam_iden, args["encoding"], args["quality"])
+        )
+        request_img = send_file(
+            BytesIO(image_basler.encode()),
+            mimetype=image_basler.mimetype(),
+        )
+        request_img.headers["X-Frame-Age-Ms"] = f"{image_basler.image_info['age_ms']:.1f}"
+        request_img.headers["X-Frame-Timestamp"] = image_basler.image_info["timestamp"]
+        return request_img
+
+
+class Stream(Resource):
+
+    # MJPEG live stream, the viewers of a camera share the same acquisition
+    def get(self, cam_iden):
+        if not check_cam_iden(cam_iden):
+            return jsonify({"error": f"Camera {cam_iden} not configured"})
+        args = stream_parser.parse_args()
+        frames = bh.stream(cam_iden, args["scale"], args["fps"], args["quality"])
+
+        # first frame, to report errors before starting the stream
+        first_frame = next(frames, None)
+        if first_frame is None:
+            return jsonify({"error": f"Stream of camera {cam_iden} not available"})
+
+        def multipart():
+            try:
+                for frame in itertools.chain([first_frame], frames):
+                    yield (
+                        b"--frame\r\n"
+                        + b"Content-Type: image/jpeg\r\n"
+                        + f"Content-Length: {len(frame)}\r\n\r\n".encode()
+                        + frame
+                        + b"\r\n"
+                    )
+            finally:
+                # the viewer left, release the shared acquisition
+                frames.close()
+
+        return Response(
+            stream_with_context(multipart()),
+            mimetype="multipart/x-mixed-replace; boundary=frame",
+        )
 
 
 class QRCode(Resource):
     def get(self, cam_iden):
-        image_info = bh.get_last_img_info(cam_iden)
-        image_path = image_info["image_path"]
-        qr_data = bh.qrcodes.decode(image_path)
+        args = qrcode_parser.parse_args()
+        qr_data = bh.get_qrcodes(cam_iden, args["wait"])
         return jsonify(qr_data)
 
 
@@ -92,6 +181,18 @@ class ListCamerasDetected(Resource):
         return jsonify(devices_info)
 
 
+class ParameterCacheStats(Resource):
+
+    def get(self):
+        return jsonify(bh.get_parameter_cache_stats())
+
+
+class FramePoolStats(Resource):
+
+    def get(self):
+        return jsonify(bh.get_frame_pool_stats())
+
+
 class ConfigureCameras(Resource):
 
     def get(self):
@@ -136,6 +237,35 @@ class SetRotation(Resource):
             return res
 
 
+class SetEncoding(Resource):
+    def get(self, cam_iden, encoding):
+        if not check_cam_iden(cam_iden):
+            return jsonify({"error": f"Camera {cam_iden} not configured"})
+        args = image_parser.parse_args()
+        res = bh.set_default_encoding(cam_iden, encoding, args["quality"])
+        if res == {}:
+            bh._load_configured_cams()
+            devices_info = bh._devices_info_configured
+            return jsonify(devices_info[cam_iden])
+        else:
+            print(res)
+            return res
+
+
+class SetPixelFormat(Resource):
+    def get(self, cam_iden, pixel_format):
+        if not check_cam_iden(cam_iden):
+            return jsonify({"error": f"Camera {cam_iden} not configured"})
+        res = bh.set_default_pixel_format(cam_iden, pixel_format)
+        if res == {}:
+            bh._load_configured_cams()
+            devices_info = bh._devices_info_configured
+            return jsonify(devices_info[cam_iden])
+        else:
+            print(res)
+            return res
+
+
 class ChangeIdentifier(Resource):
     def get(self, cam_iden, new_iden):
         if not check_cam_iden(cam_iden):
@@ -152,13 +282,21 @@ class ChangeIdentifier(Resource):
 
 # add resource at endpoint camera/string
 api.add_resource(Image, "/camera/<string:cam_iden>")
+api.add_resource(Snapshot, "/camera/<string:cam_iden>/snapshot")
+api.add_resource(Stream, "/camera/<string:cam_iden>/stream")
 api.add_resource(ImageInfo, "/camera/<string:cam_iden>/image_info")
 api.add_resource(CameraInfo, "/camera/<string:cam_iden>/camera_info")
 api.add_resource(ListCameras, "/list_cameras")
 api.add_resource(ListCamerasDetected, "/list_cameras_detected")
+api.add_resource(ParameterCacheStats, "/parameter_cache")
+api.add_resource(FramePoolStats, "/frame_pool")
 api.add_resource(ConfigureCameras, "/configure_cameras")
 api.add_resource(SetExposure, "/set_exposure/<string:cam_iden>/<string:exposure_time>")
 api.add_resource(SetRotation, "/set_rotation/<string:cam_iden>/<string:rotation>")
+api.add_resource(SetEncoding, "/set_encoding/<string:cam_iden>/<string:encoding>")
+api.add_resource(
+    SetPixelFormat, "/set_pixel_format/<string:cam_iden>/<string:pixel_format>"
+)
 api.add_resource(ChangeIdentifier, "/change_iden/<string:cam_iden>/<string:new_iden>")
 api.add_resource(QRCode, "/camera/<string:cam_iden>/qrcodes")
 